@@ -5,15 +5,140 @@ import random
 import optuna
 import optuna.visualization as vis
 import sys
+import os
+import argparse
+import multiprocessing
+import hashlib
+import json
+import sqlite3
+import queue
+import threading
+import socket
+import shutil
+import subprocess
+import contextlib
+import functools
+import inspect
+import re
+import collections
 
 # read command line arguments (Used to run specific funtion at file end)
-map = sys.argv[1]
-training = int(sys.argv[2])
-trials = int(sys.argv[3])
-drawing = int(sys.argv[3])
+parser = argparse.ArgumentParser(description="Particle Life Simulation")
+parser.add_argument("map", help="'valley', 'box' or 'bench'")
+parser.add_argument("training", type=int, help="1 = training, 0 = regular simulation")
+parser.add_argument("trials", type=int, help="Number of trials when training")
+parser.add_argument("drawing", type=int, help="1 = draw simulation, 0 = no rendering")
+parser.add_argument("--arch", default="gpu", choices=["gpu", "cpu", "cuda", "vulkan", "metal", "opengl"], help="Taichi backend")
+parser.add_argument("--threads", type=int, default=None, help="Max number of CPU threads (Only for cpu arch)")
+parser.add_argument("--precision", default="f32", choices=["f32", "f64"], help="Default float precision of fields and kernels")
+parser.add_argument("--headless", action="store_true", help="Never open a window or browser (No drawing and no plots)")
+parser.add_argument("--workers", type=int, default=1, help="Number of worker processes sharing the studies when training")
+parser.add_argument("--storage", default="sqlite", choices=["sqlite", "journal"], help="Study storage: db.sqlite3 or the journal file db.journal")
+parser.add_argument("--pruner", default="none", choices=["none", "median", "hyperband"], help="Optuna pruner stopping hopeless trials early")
+parser.add_argument("--report-every", type=int, default=500, help="Ticks between intermediate rewards reported to the pruner")
+parser.add_argument("--seed", type=int, default=None, help="Seed for the initial particle layout of every trial")
+parser.add_argument("--deterministic", action="store_true", help="Reproducible runs: race-free eating and one CPU thread (Seed 0 if none is given)")
+parser.add_argument("--cache", action="store_true", help="Reuse results of trials already simulated with the same parameters and seed")
+parser.add_argument("--renderer", default="ggui", choices=["ggui", "gui"], help="'ggui' draws straight from the fields on the device, 'gui' is the legacy Taichi GUI")
+parser.add_argument("--fps", type=int, default=60, help="Max frames per second of the regular simulation (0 = draw every tick)")
+parser.add_argument("--record", default=None, help="File the regular simulation is recorded to")
+parser.add_argument("--record-trials", action="store_true", help="Record every trial to the folder 'recordings' when training")
+parser.add_argument("--record-every", type=int, default=10, help="Ticks between recorded frames")
+parser.add_argument("--replay", default=None, help="Replay a recording file, or the recording of the best trial of a study")
+parser.add_argument("--export", default=None, help="Folder the regular simulation or a replay is exported to as images, without a window")
+parser.add_argument("--export-frames", type=int, default=300, help="Number of exported frames of the regular simulation")
+parser.add_argument("--export-every", type=int, default=4, help="Ticks between exported frames of the regular simulation")
+parser.add_argument("--export-video", action="store_true", help="Also encode the exported images to video.mp4 (Needs ffmpeg)")
+parser.add_argument("--export-workers", type=int, default=4, help="Number of threads writing exported images")
+parser.add_argument("--layout", default="soa", choices=["soa", "aos"], help="Particle state layout: separate arrays (soa) or one struct per particle (aos)")
+parser.add_argument("--state-precision", default=None, choices=["f32", "f64"], help="Float precision of positions and velocities (Default is --precision)")
+parser.add_argument("--packed-alive", action="store_true", help="Store the alive flags as bits (32 particles per word)")
+parser.add_argument("--type-capacity", action="store_true", help="Only allocate memory for 'foodAmount' food particles (Sparse blocks, cpu and cuda only)")
+parser.add_argument("--bench-archs", default=None, help="Comma separated archs swept by the benchmark suite (Default is --arch)")
+parser.add_argument("--bench-threads", default=None, help="Comma separated CPU thread counts swept by the benchmark suite")
+parser.add_argument("--bench-out", default="benchmark.json", help="File the results of the benchmark suite are saved to")
+parser.add_argument("--bench-compare", default=None, help="Baseline file of an earlier benchmark suite to compare with")
+parser.add_argument("--bench-tolerance", type=float, default=0.1, help="Slowdown compared to the baseline that counts as a regression")
+parser.add_argument("--engine", default="exact", choices=["exact", "grid", "barnes_hut"], help="Engine of the velocity update")
+parser.add_argument("--cutoff", type=float, default=0.05, help="Interaction range of the grid engine (Never smaller than the collision range)")
+parser.add_argument("--bh-theta", type=float, default=0.5, help="Opening angle of the Barnes-Hut engine (Lower = more accurate, but slower)")
+parser.add_argument("--species", type=int, default=1, help="Number of particle species on the box map (Random force matrix between the species)")
+parser.add_argument("--particles", type=int, default=500, help="Number of main particles of the regular simulation (Split between the species)")
+parser.add_argument("--batch", type=int, default=1, help="Simulations stepped together, and trials asked from Optuna together when training")
+parser.add_argument("--ensemble", type=int, default=0, help="Score every trial on the same N seeds and use the mean (0 = one layout per trial)")
+parser.add_argument("--ensemble-round", type=int, default=4, help="Seeds of an ensemble simulated together in one batch")
+parser.add_argument("--ensemble-se", type=float, default=0.0, help="Stop adding seeds when the standard error of the mean is below this")
+parser.add_argument("--integrator", default="fixed", choices=["fixed", "adaptive"], help="'fixed' moves one tick per step, 'adaptive' chooses the step size from the fastest particle")
+parser.add_argument("--cfl", type=float, default=0.5, help="Largest part of the collision range a particle moves in one adaptive step")
+parser.add_argument("--dt-max", type=float, default=4.0, help="Largest adaptive step in ticks")
+parser.add_argument("--early-stop", action="store_true", help="End trials when all food is eaten, all main particles have fallen or the simulation is steady")
+parser.add_argument("--steady-window", type=int, default=200, help="Ticks of low kinetic energy (And no food eaten) before a simulation is steady (0 = only terminal states)")
+parser.add_argument("--steady-energy", type=float, default=0.01, help="Mean kinetic energy of the main particles below which a simulation is calm (Fraction of the energy at max speed)")
+parser.add_argument("--fidelity", type=int, default=1, help="Rungs of successive halving: trials are scored with fewer ticks and particles first (1 = full fidelity only)")
+parser.add_argument("--fidelity-eta", type=int, default=3, help="Factor between the rungs of successive halving (Ticks and particles, and the share of trials promoted)")
+parser.add_argument("--gradient", action="store_true", help="Train by gradient ascent on a differentiable simulation instead of Optuna (arg3 = iterations)")
+parser.add_argument("--grad-ticks", type=int, default=0, help="Ticks of the differentiable simulation (0 = ticks of the objective)")
+parser.add_argument("--grad-segment", type=int, default=100, help="Ticks kept in memory by the differentiable simulation (Checkpoint interval)")
+parser.add_argument("--grad-horizon", type=int, default=10, help="Last ticks the gradient is taken through (Earlier ticks are simulated without gradient)")
+parser.add_argument("--grad-lr", type=float, default=0.05, help="Step size of the gradient ascent (Fraction of the range of a parameter)")
+parser.add_argument("--grad-smooth", type=float, default=2.0, help="Width of the smooth surrogates in particle radii")
+parser.add_argument("--profile", action="store_true", help="Store a time breakdown of every trial (Kernel profiler and wall timers) as trial attributes")
+parser.add_argument("--profile-stages", action="store_true", help="Profile every stage of a tick as its own kernel launch instead of the fused ticks (Turns on --profile)")
+parser.add_argument("--profile-stream", default=None, help="Also append the time breakdown of every trial to a JSON lines file")
+parser.add_argument("--warm-start", action="store_true", help="Start valley trials from a cached state where the particles have already fallen to the ground")
+parser.add_argument("--ticks-per-launch", type=int, default=4, choices=[1, 2, 4, 8, 16, 32], help="Ticks fused into one kernel launch")
+parser.add_argument("--kernel-cache", default="kernel_cache", help="Folder of the offline cache of compiled kernels")
+parser.add_argument("--checkpoint-every", type=int, default=0, help="Ticks between checkpoints of running trials, resumed after a crash (0 = never)")
 
-# Initializes Taichi - Use GPU
-ti.init(arch=ti.gpu)
+# main.py is run as a program (Or as a worker process of training), otherwise it is imported and
+# only reads the default options (See 'Simulation')
+run_as_program = __name__ in ["__main__", "__mp_main__"]
+args = parser.parse_args(None if run_as_program else ["box", "0", "1", "0", "--headless"])
+
+map = args.map
+training = args.training
+trials = args.trials
+drawing = args.drawing
+headless = args.headless
+if headless:
+    drawing = 0
+
+# Deterministic runs always use a seed
+seed = args.seed
+deterministic = args.deterministic
+if deterministic and seed is None:
+    seed = 0
+
+# Worker processes of parallel training get their share of the CPU cores from the main process
+worker_cpus = os.environ.get("PARTICLE_LIFE_WORKER_CPUS")
+if worker_cpus:
+    drawing = 0
+
+# Initializes Taichi with the chosen backend (GPU by default)
+archs = {"gpu": ti.gpu, "cpu": ti.cpu, "cuda": ti.cuda, "vulkan": ti.vulkan, "metal": ti.metal, "opengl": ti.opengl}
+init_options = {"arch": archs[args.arch], "default_fp": ti.f64 if args.precision == "f64" else ti.f32}
+if args.threads is not None:
+    init_options["cpu_max_num_threads"] = args.threads
+if worker_cpus:
+    cpus = [int(cpu) for cpu in worker_cpus.split(",")]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    if args.threads is None:
+        init_options["cpu_max_num_threads"] = len(cpus)
+
+# The kernel profiler measures the device time of every kernel
+profiling = args.profile or args.profile_stream is not None or args.profile_stages
+profile_stages = args.profile_stages            # Unfused ticks, so the kernel profiler can tell the stages apart
+if profiling:
+    init_options["kernel_profiler"] = True
+
+# One thread gives a fixed order of all parallel loops (Only on CPU, GPU results may still vary)
+if deterministic:
+    init_options["cpu_max_num_threads"] = 1
+
+# Compiled kernels are kept in the offline cache, so later processes load them instead of compiling again
+init_options["offline_cache"] = True
+init_options["offline_cache_file_path"] = os.path.abspath(args.kernel_cache)
 
 # Definition of GUI dimensions
 width = 1800
@@ -24,7 +149,7 @@ boxHeight = 0.4
 boxWidth = 0.4
 
 # Colors for particle types
-colors = [0xff5050, 0x80ff80, 0x8080ff, 0xffAA00]
+colors = [0xff5050, 0x80ff80, 0x8080ff, 0xffAA00, 0xff50ff, 0x50ffff, 0xffff50, 0xffffff]
 
 # Parameters for general physics
 foodAmount = 30                     # Number of food particles when in valley
@@ -32,223 +157,1721 @@ coll_range = 30                     # Range for guranteed repulsion force in the
 force_mult = 20                     # Multiplier for stength of particle interaction forces
 
 # Standards for physics (Can be overwritten for training phase)
-glob_amount = 500                   # Number of main particles
+glob_amount = args.particles        # Number of main particles
 glob_gravity = 0.12              
 glob_max_speed = 0.0025             # Maximum speed pr. tick
 glob_coll_force = 300               # Repulsion force when in range of coll_range
 
-# Particle radius and number of particle types
+# Particle radius and number of particle types. On the valley map type 0 is the main particles and
+# type 1 is food, while the box map has 'species' types of main particles
 rad = 3
-types = 2
+species = args.species
+types = max(2, species)
+if types > len(colors):
+    sys.exit(f"At most {len(colors)} species are supported")
+
+# Function for the number of particles each type can have with 'amount' main particles on the maps in
+# 'maps'. Valley main particles are all type 0 and food is type 1 (At most 'foodAmount'), while the
+# main particles of the box map are split between the species. Unused types have no particles
+def capacities_for(amount, maps, species_count):
+    counts = [0] * max(2, species_count)
+    if "valley" in maps:
+        counts[0] = amount
+        counts[1] = foodAmount
+    if "box" in maps:
+        for i in range(species_count):
+            counts[i] = max(counts[i], (amount + species_count - 1) // species_count)
+    return counts
+
+
+# Capacity of the particle fields (Trials of the box map have 500 particles, and the benchmarks use
+# arg3 as largest particle amount on both maps). 'capacity' is the particles of the largest type
+field_maps = [map] if map in ["valley", "box"] else ["valley", "box"]
+field_amount = max(glob_amount, 500)
+if map in ["bench", "layouts", "layout-run", "suite", "suite-run"]:
+    field_amount = max(glob_amount, trials)
+capacity = max(capacities_for(field_amount, field_maps, species))
+
+# Engine for the velocity update (Set on the command line):
+#   "exact"      - every particle interacts with every other particle
+#   "grid"       - only particles within 'interaction_cutoff' interact (Uniform grid neighbor search)
+#   "barnes_hut" - far away groups of particles are approximated by their center (Quadtree per type)
+engine = args.engine
+interaction_cutoff = args.cutoff    # Interaction range of the grid engine (Never smaller than the collision range)
+bh_theta = args.bh_theta            # Opening angle of the Barnes-Hut engine (Lower = more accurate, but slower)
+bh_leaf_size = 32                   # Particles aimed for in a leaf of the quadtree (The depth is chosen from the particle amount)
+
+# Number of simulations stepped together in the same kernel launches (Each has its own particles and physics)
+batch_size = max(1, args.batch)
+
+# Trials asked from Optuna together (One simulation each)
+trial_batch_size = batch_size
+
+# Seed ensembles: every trial is scored on the same seeds (Common random numbers), and the seeds
+# of a round are simulated together in one batch
+ensemble_seeds = []
+if args.ensemble > 0:
+    ensemble_seeds = [(seed if seed is not None else 0) + k for k in range(args.ensemble)]
+    batch_size = max(batch_size, min(args.ensemble_round, args.ensemble))
+
+# Multi-fidelity: trials are first scored with a fraction of the ticks and particles (Rungs of successive
+# halving), and only the best 1 / eta of the trials of a rung are promoted to the next rung
+fidelity_rungs = max(1, args.fidelity)
+fidelity_eta = max(2, args.fidelity_eta)
+fidelity = 1.0                      # Fraction of the ticks and particles of the trials being simulated
+
+# Ticks fused into one kernel launch when nothing has to be drawn in between (Power of two). Fewer
+# ticks per launch compile faster, since the ticks of a launch are unrolled
+ticks_per_launch = args.ticks_per_launch
+
+# Tiles of the "exact" engine. On CPUs the positions of 'tile_size' source particles are read once and
+# reused by a block of 'target_block' particles while they are in the cache. On GPUs with shared memory
+# a block of 'tile_size' threads loads a tile into shared memory together, and every thread reuses it
+# for its own target
+tile_size = 64
+target_block = 1                    # Set when Taichi is started (16 on CPUs)
+shared_tiles = False                # Set when Taichi is started (True on CUDA, AMDGPU and Vulkan)
+taichi_arch = None                  # Backend Taichi was started on (Set when Taichi is started)
+
+# Layout of the particle state (Set on the command line):
+#   layout            - "soa" places positions, velocities and alive flags in separate arrays, "aos" places them together per particle
+#   state_float       - float type of positions and velocities
+#   packed_alive      - alive flags are stored as bits in 32 bit words
+#   per_type_capacity - memory is only allocated for the particles each type can have (In blocks of 'capacity_block')
+layout = args.layout
+state_float = ti.f64 if (args.state_precision or args.precision) == "f64" else ti.f32
+packed_alive = args.packed_alive
+per_type_capacity = args.type_capacity
+capacity_block = 32
+# Function for the SNode holding the particles of all simulations and types. With per type capacities,
+# the particles are split into blocks and only the blocks that are used get memory
+def particle_snode():
+    if per_type_capacity:
+        blocks = (capacity + capacity_block - 1) // capacity_block
+        return ti.root.dense(ti.ij, (batch_size, types)).pointer(ti.k, blocks).dense(ti.k, capacity_block)
+    return ti.root.dense(ti.ijk, (batch_size, types, capacity))
+
+
+scan_block = 32                                        # Particles counted by each thread of the prefix sum of the alive lists
+
+# Particles do not interact with food until this many ticks after ground contact
+food_cooldown = 300
+
+# Detection of finished simulations (Only with --early-stop). A valley simulation is finished when all main
+# particles have fallen, and any simulation is finished when the mean kinetic energy of its main particles has
+# been below 'steady_energy' of the energy at max speed (Without food being eaten) for 'steady_window' ticks
+# ("all_eaten" when it became steady with all food eaten).
+# Finished simulations do not move, and the host checks for them every 'monitor_every' ticks
+early_stop = args.early_stop
+steady_window = args.steady_window
+steady_energy = args.steady_energy
+monitor_every = 100
+finish_reasons = ["", "all_eaten", "all_fallen", "steady"]
+
+# Simulated time of the adaptive integrator (In ticks). Every step moves a simulation by 'dt' until
+# it reaches its target time, and the tick counter is the whole ticks of 'ground_time'
+adaptive = args.integrator == "adaptive"
+cfl = args.cfl                                         # Fraction of the collision range moved in one step
+dt_max = args.dt_max                                   # Longest step (In ticks)
+
+# Uniform grid for the neighbor search. Cells are as wide as the cutoff (Or the collision range), so every
+# interaction partner is in the 3x3 neighboring cells. Food is eaten in a separate check, so the eat range
+# does not widen the cells
+cell_width = max(interaction_cutoff, coll_range * rad / width)
+grid_res = max(1, int(1 / cell_width))
+
+# Function for the depth of the Barnes-Hut quadtree for an amount of particles. Leaves hold about
+# 'bh_leaf_size' particles of a type, so the work per particle grows with the depth (log N)
+def tree_depth(amount):
+    depth = 1
+    while depth < 9 and amount > bh_leaf_size * 4 ** depth:
+        depth += 1
+    return depth
+
+
+# Quadtree for the Barnes-Hut engine. All levels are stored after each other (Level L has 4^L nodes),
+# and each node holds the number and position sum of the alive particles of each type inside it.
+# Fields are allocated for the deepest tree of the capacity (Set with the fields), and every tick only
+# uses the levels of its amount
+bh_depth = 1
+bh_leaf_res = 2
+bh_nodes = 5
+
+# Grid for counting nearby particles in the clustering reward (Cells are as wide as the reward range)
+reward_grid_res = int(width / (5 * rad))
+
+
+# Function for allocating all fields for 'batch_size' simulations of 'types' particle types with
+# 'capacity' particles each (Kernels read the fields as globals, so they always use the latest ones)
+def allocate_fields():
+    global type_capacities, positions, velocities, alive_words, alive_bits, alive, state_particle_fields, type_capacity
+    global forces, eaten_mark, live_count, live_ids, live_dirty, live_block_start, live_pos
+    global sim_amount, gravities, host_gravities, max_speeds, coll_forces, tick_count
+    global dt, sim_time, target_time, ground_time, speed_max, integrator_steps, has_food, touched_ground
+    global finished, finish_reason, finished_at, calm_time, last_food, kinetic_energy
+    global cell_count, cell_offset, cell_particles, sorted_pos, sorted_force, particle_cell, particle_slot
+    global node_count, node_pos_sum, leaf_count, leaf_offset, leaf_particles, bh_depth, bh_leaf_res, bh_nodes
+    global reward_cell_count, reward_cell_offset, reward_cell_particles, eaten_result, close_result, cluster_result
+    global accelerations, render_positions, render_radius, render_colors, box_vertices, export_image, export_ids, state_fields
+    
+    # Number of particles of each type (Food never has more than 'foodAmount', and each species has its share)
+    type_capacities = [capacity] * types
+    if per_type_capacity:
+        type_capacities = capacities_for(field_amount, field_maps, species)
+    
+    # Fields to hold data on all particles (First index is the simulation in the batch)
+    positions = ti.Vector.field(2, dtype=state_float)
+    velocities = ti.Vector.field(2, dtype=state_float)
+    if packed_alive:
+        alive_words = (capacity + 31) // 32
+        alive_bits = ti.field(ti.u32, shape=(batch_size, types, alive_words))
+    else:
+        alive = ti.field(bool)
+    
+    state_particle_fields = [positions, velocities]
+    if not packed_alive:
+        state_particle_fields.append(alive)
+    if layout == "aos":
+        particle_snode().place(*state_particle_fields)
+    else:
+        for field in state_particle_fields:
+            particle_snode().place(field)
+    
+    # Number of particles of each type on the device
+    type_capacity = ti.field(int, shape=types)
+    type_capacity.from_numpy(np.array(type_capacities, dtype=np.int32))
+    
+    # Field for definition of forces
+    forces = ti.field(float, shape=(batch_size, types, types))
+    
+    # Food marked as eaten during a velocity update (Removed after the update in deterministic runs)
+    eaten_mark = ti.field(bool, shape=(batch_size, foodAmount))
+    
+    # Indices of the alive particles of each type in increasing order (Rebuilt on the device when particles die)
+    live_count = ti.field(int, shape=(batch_size, types))
+    live_ids = ti.field(int, shape=(batch_size, types, capacity))
+    live_dirty = ti.field(bool, shape=batch_size)                           # Set when particles of a simulation die or are added
+    live_block_start = ti.field(int, shape=(batch_size, types, (capacity + scan_block - 1) // scan_block))
+    live_pos = ti.Vector.field(2, dtype=state_float, shape=(batch_size, types, capacity))   # Positions in the order of the lists
+    
+    # Fields for the physics of each simulation
+    sim_amount = ti.field(int, shape=batch_size)          # Number of main particles
+    gravities = ti.field(float, shape=batch_size)
+    host_gravities = [glob_gravity] * batch_size             # Gravities on the host (Kernels are chosen without reading the device)
+    max_speeds = ti.field(float, shape=batch_size)
+    coll_forces = ti.field(float, shape=batch_size)
+    
+    # Tick counter of each simulation (Starts after a particle touches ground)
+    tick_count = ti.field(int, shape=batch_size)
+    
+    # Step size and simulated time of the adaptive integrator
+    dt = ti.field(float, shape=batch_size)
+    sim_time = ti.field(float, shape=batch_size)
+    target_time = ti.field(float, shape=batch_size)
+    ground_time = ti.field(float, shape=batch_size)        # Simulated time since a particle touched ground
+    speed_max = ti.field(float, shape=batch_size)          # Speed of the fastest particle (Device reduction)
+    integrator_steps = ti.field(int, shape=batch_size)
+    has_food = ti.field(bool, shape=batch_size)           # Type 1 is food (Valley map) instead of a species
+    touched_ground = ti.field(bool, shape=batch_size)
+    
+    # Detection of finished simulations
+    finished = ti.field(bool, shape=batch_size)
+    finish_reason = ti.field(int, shape=batch_size)       # Index in 'finish_reasons'
+    finished_at = ti.field(int, shape=batch_size)         # Ticks simulated when the simulation finished
+    calm_time = ti.field(float, shape=batch_size)         # Ticks since the simulation became calm
+    last_food = ti.field(int, shape=batch_size)           # Alive food in the previous tick
+    kinetic_energy = ti.field(float, shape=batch_size)
+    
+    # Uniform grid of the grid engine
+    cell_count = ti.field(int, shape=(batch_size, grid_res * grid_res))         # Number of particles in each cell
+    cell_offset = ti.field(int, shape=(batch_size, grid_res * grid_res))        # Start of each cell in 'cell_particles' (Prefix sum of counts)
+    cell_particles = ti.field(int, shape=(batch_size, types * capacity))        # Particle ids (type * capacity + index) sorted by cell
+    sorted_pos = ti.Vector.field(2, dtype=state_float, shape=(batch_size, types * capacity))  # Positions in the order of the cells (Or leaves)
+    sorted_force = ti.Vector.field(2, dtype=float, shape=(batch_size, types * capacity))      # Forces in the order of the leaves
+    particle_cell = ti.field(int, shape=(batch_size, types, capacity))          # Cell of each particle
+    particle_slot = ti.field(int, shape=(batch_size, types, capacity))          # Position of each particle within its cell
+    
+    # Quadtrees of the Barnes-Hut engine
+    bh_depth = tree_depth(capacity)
+    bh_leaf_res = 2 ** bh_depth
+    bh_nodes = (4 ** (bh_depth + 1) - 1) // 3
+    node_count = ti.field(int, shape=(batch_size, types, bh_nodes))
+    node_pos_sum = ti.Vector.field(2, dtype=float, shape=(batch_size, types, bh_nodes))
+    leaf_count = ti.field(int, shape=(batch_size, types * bh_leaf_res * bh_leaf_res))   # Particles in the leaves are sorted like the grid (Every type has its own leaves)
+    leaf_offset = ti.field(int, shape=(batch_size, types * bh_leaf_res * bh_leaf_res))
+    leaf_particles = ti.field(int, shape=(batch_size, types * capacity))
+    
+    # Grid of the clustering reward
+    reward_cell_count = ti.field(int, shape=(batch_size, reward_grid_res * reward_grid_res))
+    reward_cell_offset = ti.field(int, shape=(batch_size, reward_grid_res * reward_grid_res))
+    reward_cell_particles = ti.field(int, shape=(batch_size, types * capacity))
+    
+    # Fields for reward results of each simulation
+    eaten_result = ti.field(int, shape=batch_size)
+    close_result = ti.field(float, shape=batch_size)
+    cluster_result = ti.field(float, shape=batch_size)
+    
+    # Field for accelerations when comparing engines
+    accelerations = ti.Vector.field(2, dtype=float, shape=(batch_size, types, capacity))
+    
+    # Fields read by the GGUI renderer (One vertex per particle of the first simulation)
+    render_positions = ti.Vector.field(2, dtype=float, shape=types * capacity)
+    render_radius = ti.field(float, shape=types * capacity)
+    render_colors = ti.Vector.field(3, dtype=float, shape=types * capacity)
+    box_vertices = ti.Vector.field(2, dtype=float, shape=16)             # Outlines of the two boxes (Pairs of line ends)
+    
+    # Image of an exported frame, and the particle drawn on each pixel (Highest id + 1 wins, 0 = none)
+    export_image = ti.Vector.field(3, dtype=ti.u8, shape=(width, height))
+    export_ids = ti.field(int, shape=(width, height))
+    
+    # Fields of the state of all simulations besides the particles (Everything else is rebuilt every tick)
+    state_fields = {
+        "forces": forces,
+        "sim_amount": sim_amount,
+        "gravities": gravities,
+        "max_speeds": max_speeds,
+        "coll_forces": coll_forces,
+        "tick_count": tick_count,
+        "touched_ground": touched_ground,
+        "has_food": has_food,
+        "sim_time": sim_time,
+        "target_time": target_time,
+        "ground_time": ground_time,
+        "integrator_steps": integrator_steps,
+        "finished": finished,
+        "finish_reason": finish_reason,
+        "finished_at": finished_at,
+        "calm_time": calm_time,
+        "last_food": last_food
+        }
+
+
+# The Taichi runtime and the fields are created by 'start_taichi' (Right away when main.py is run,
+# and by 'Simulation' when main.py is imported, so importing it has no side effects)
+taichi_started = False
+taichi_options = None               # Options the running Taichi runtime was started with
+
+
+# Function for starting the Taichi runtime and allocating all fields. A running runtime is reset first,
+# so the fields can get new sizes without restarting the process (Kernels are then compiled again,
+# which mostly loads them from the offline cache). Without options, the options of the command line are used
+def start_taichi(options=None):
+    global taichi_started, taichi_options, target_block, shared_tiles, taichi_arch
+    if options is None:
+        options = init_options
+    if taichi_started:
+        ti.reset()
+        settled_states.clear()
+        compiled_configs.clear()
+        launched_configs.clear()
+    
+    # 'gpu' takes the first GPU backend that starts (In the order of Taichi), otherwise the CPU. Backends
+    # are tried one by one, so the kernels know the backend they run on. OpenGL is only used when asked
+    # for, since trying it without a display crashes the process
+    candidates = [options["arch"]]
+    if options["arch"] == ti.gpu:
+        candidates = [arch for arch in ti.gpu if arch not in [ti.opengl, ti.gles]] + [ti.cpu]
+    for arch in candidates:
+        try:
+            ti.init(**dict(options, arch=arch, enable_fallback=False))
+            taichi_arch = arch
+            break
+        except RuntimeError:
+            if arch == candidates[-1]:
+                raise
+    taichi_started = True
+    taichi_options = options
+    
+    target_block = 16 if taichi_arch == ti.cpu else 1
+    shared_tiles = taichi_arch in [ti.cuda, ti.amdgpu, ti.vulkan]
+    allocate_fields()
+
+
+if run_as_program:
+    start_taichi()
+
+# Function for the alive flag of a particle (Used inside kernels)
+@ti.func
+def alive_at(b, i, j):
+    result = False
+    if ti.static(packed_alive):
+        result = (alive_bits[b, i, j // 32] >> ti.cast(j % 32, ti.u32)) & 1 != 0
+    else:
+        result = alive[b, i, j] != 0
+    return result
+
+
+# Function for setting the alive flag of a particle (Used inside kernels)
+@ti.func
+def set_alive(b, i, j, value):
+    if ti.static(packed_alive):
+        bit = ti.u32(1) << ti.cast(j % 32, ti.u32)
+        if value:
+            ti.atomic_or(alive_bits[b, i, j // 32], bit)
+        else:
+            ti.atomic_and(alive_bits[b, i, j // 32], ~bit)
+    else:
+        alive[b, i, j] = value
+
+
+# Function for the alive flags of all particles as a numpy array of (batch_size, types, capacity)
+# (Read by a kernel, since 'to_numpy' misses flags of boolean fields in the sparse blocks of --type-capacity)
+def alive_to_numpy():
+    if packed_alive:
+        words = alive_bits.to_numpy().astype("<u4")
+        return np.unpackbits(words.view(np.uint8), axis=-1, bitorder="little")[:, :, :capacity].astype(bool)
+    
+    is_alive = np.zeros((batch_size, types, capacity), dtype=np.int32)
+    read_alive(is_alive)
+    return is_alive.astype(bool)
+
+
+# Function for copying the alive flags of all simulations to a numpy array
+@ti.kernel
+def read_alive(is_alive: ti.types.ndarray()):
+    for b, i, j in ti.ndrange(batch_size, types, capacity):
+        if j < type_capacity[i]:
+            is_alive[b, i, j] = alive_at(b, i, j)
+
+
+# Function for the bytes of memory used by the particle state of all simulations
+def state_bytes():
+    float_bytes = 8 if state_float == ti.f64 else 4
+    slots = 0
+    for i in range(types):
+        slots += type_capacities[i]
+        if per_type_capacity:
+            slots += -type_capacities[i] % capacity_block
+    
+    alive_bytes = 0 if packed_alive else slots
+    if packed_alive:
+        alive_bytes = types * alive_words * 4
+    return batch_size * (slots * 4 * float_bytes + alive_bytes)
+
+
+# Taichi GUI or GGUI window (Only created when something is drawn, so training without drawing needs no display)
+gui = None
+renderer = args.renderer
+
+
+# Function for getting the GUI (Created on first use, GGUI falls back to the legacy GUI without Vulkan)
+def get_gui():
+    global gui, renderer
+    if gui is None and renderer == "ggui":
+        try:
+            gui = ti.ui.Window("Particle Life", res=(width, height), vsync=False)
+            setup_render_fields()
+        except RuntimeError as error:
+            print(f"GGUI is not available ({error}), using the legacy GUI")
+            renderer = "gui"
+    if gui is None:
+        gui = ti.GUI("Particle Life", res=(width, height), background_color=0x000000)
+    return gui
+
 
-# Fields to hold data on all particles
-positions = ti.Vector.field(2, dtype=float, shape=(types, glob_amount))
-velocities = ti.Vector.field(2, dtype=float, shape=(types, glob_amount))
-alive = ti.field(bool, shape=(types, glob_amount))
+# Function for removing all particles of simulation b
+@ti.kernel
+def clear_simulation(b: int):
+    live_dirty[b] = True
+    for i, j in ti.ndrange(types, capacity):
+        if j < type_capacity[i]:
+            set_alive(b, i, j, False)
+            positions[b, i, j] = [-1, 1]
+            velocities[b, i, j] = [0.0, 0.0]
+
+
+# Function for setting the physics of simulation b
+def set_physics(b, gravity, max_speed, coll_force, checkGround=True):
+    gravities[b] = gravity
+    host_gravities[b] = gravity
+    max_speeds[b] = max_speed
+    coll_forces[b] = coll_force
+    
+    # Ticker starts after a particle touches ground (Or right away when ground is not checked)
+    tick_count[b] = 0
+    touched_ground[b] = not checkGround
+    
+    # Simulated time of the adaptive integrator
+    sim_time[b] = 0
+    target_time[b] = 0
+    ground_time[b] = 0
+    integrator_steps[b] = 0
+    
+    # Detection of finished simulations
+    finished[b] = False
+    finish_reason[b] = 0
+    finished_at[b] = 0
+    calm_time[b] = 0
+    last_food[b] = foodAmount
+
+
+# Numpy types matching the fields
+np_float = np.float64 if args.precision == "f64" else np.float32
+np_state_float = np.float64 if state_float == ti.f64 else np.float32
 
-# Field for definition of forces
-forces = ti.field(float, shape=(types, types))
 
-# Taichi GUI setup
-gui = ti.GUI("Particle Life", res=(width, height), background_color=0x000000)
+# Function for numpy arrays of one empty simulation (Particles are removed and parked at [-1, 1])
+def empty_simulation():
+    pos = np.zeros((types, capacity, 2), dtype=np_state_float)
+    pos[:, :] = [-1, 1]
+    vel = np.zeros((types, capacity, 2), dtype=np_state_float)
+    is_alive = np.zeros((types, capacity), dtype=np.int32)
+    sim_forces = np.zeros((types, types), dtype=np_float)
+    return pos, vel, is_alive, sim_forces
 
 
-# Initializes environment for valley map
-def initValley(amount):
+# Function for writing particles and forces of simulation b from numpy arrays (One copy to the device)
+@ti.kernel
+def load_simulation(b: int, pos: ti.types.ndarray(), vel: ti.types.ndarray(), is_alive: ti.types.ndarray(), sim_forces: ti.types.ndarray()):
+    live_dirty[b] = True
+    for i, j in ti.ndrange(types, capacity):
+        if j < type_capacity[i]:
+            positions[b, i, j] = [pos[i, j, 0], pos[i, j, 1]]
+            velocities[b, i, j] = [vel[i, j, 0], vel[i, j, 1]]
+            set_alive(b, i, j, is_alive[i, j] != 0)
+    
+    for i, iOther in ti.ndrange(types, types):
+        forces[b, i, iOther] = sim_forces[i, iOther]
+
+
+# Function for checking that the particles of a layout fit in the fields (Particles that do not fit would be lost)
+def check_capacity(counts):
+    for i, count in enumerate(counts):
+        if count > type_capacities[i]:
+            raise ValueError(f"{count} particles of type {i} do not fit in the fields (Capacity {type_capacities[i]})")
+
+
+# Initializes environment for valley map (The same seed always gives the same layout).
+# With 'keep' only the first main particles of the layout are kept (A subsample of the same layout)
+def initValley(amount, b=0, seed=None, keep=None):
+    check_capacity(capacities_for(amount, ["valley"], 1))
+    pos, vel, is_alive, sim_forces = empty_simulation()
+    rng = random.Random(seed) if seed is not None else random
+    
     # Initialize all main particles
     for j in range(amount):
-        positions[0, j] = [random.random()*boxWidth, (random.random()*0.5) + boxHeight + 0.05]
-        velocities[0, j] = [0.0, 0.0]
-        alive[0, j] = True
+        pos[0, j] = [rng.random()*boxWidth, (rng.random()*0.5) + boxHeight + 0.05]
+        is_alive[0, j] = 1
     
     # Initialize all food particles
     for k in range(foodAmount):
-        positions[1, k] = [random.random()*boxWidth + (1-boxWidth), random.random()*0.5 + boxHeight+0.05]
-        velocities[1, k] = [0.0, 0.0]
-        alive[1, k] = True
+        pos[1, k] = [rng.random()*boxWidth + (1-boxWidth), rng.random()*0.5 + boxHeight+0.05]
+        is_alive[1, k] = 1
+    
+    # Remove the main particles that are not kept (Food is always kept)
+    if keep is not None:
+        pos[0, keep:amount] = [-1, 1]
+        is_alive[0, keep:amount] = 0
+        amount = keep
     
     # Set forces for particle interaction (Positive = attraction)
-    forces[0, 0] = 0.15
-    forces[0, 1] = 0.9
-    forces[1, 0] = 0
-    forces[1, 1] = 1
+    sim_forces[0, 0] = 0.15
+    sim_forces[0, 1] = 0.9
+    sim_forces[1, 0] = 0
+    sim_forces[1, 1] = 1
+    
+    load_simulation(b, pos, vel, is_alive, sim_forces)
+    sim_amount[b] = amount
+    has_food[b] = True
 
 
-# Initializes environment for box map
-def initBox(amount):
+# Initializes environment for box map (The same seed always gives the same layout).
+# The main particles are split between the species (Particle j is species j % species).
+# With 'keep' only the first main particles of the layout are kept (A subsample of the same layout)
+def initBox(amount, b=0, seed=None, keep=None):
+    check_capacity(capacities_for(amount, ["box"], species))
+    pos, vel, is_alive, sim_forces = empty_simulation()
+    rng = random.Random(seed) if seed is not None else random
+    
     # Initialize all main particles
     for j in range(amount):
-        positions[0, j] = [random.random(), (random.random())]
-        velocities[0, j] = [0.0, 0.0]
-        alive[0, j] = True
+        pos[j % species, j // species] = [rng.random(), (rng.random())]
+        is_alive[j % species, j // species] = 1
         
-    # Set force for particle attraction
-    forces[0, 0] = 0.5
+    # Set force for particle attraction (Random forces between species)
+    sim_forces[0, 0] = 0.5
+    for i in range(species):
+        for iOther in range(species):
+            if i != 0 or iOther != 0:
+                sim_forces[i, iOther] = rng.uniform(-1, 1)
+    
+    # Remove the particles that are not kept
+    if keep is not None:
+        for j in range(keep, amount):
+            pos[j % species, j // species] = [-1, 1]
+            is_alive[j % species, j // species] = 0
+        amount = keep
+    
+    load_simulation(b, pos, vel, is_alive, sim_forces)
+    sim_amount[b] = amount
+    has_food[b] = False
 
 
-# Function for updating all particle velocities
-@ti.kernel
-def update_vel(tickCount: int, max_speed: float, coll_force: int, gravity: float, particle_amount: int):
+# Function for copying the state of all simulations to numpy arrays
+# (Particles are always (batch_size, types, capacity), so snapshots do not depend on the layout)
+def snapshot():
+    arrays = {name: field.to_numpy() for name, field in state_fields.items()}
+    arrays["positions"] = positions.to_numpy()[:, :, :capacity]
+    arrays["velocities"] = velocities.to_numpy()[:, :, :capacity]
+    arrays["alive"] = alive_to_numpy()
+    return arrays
+
+
+# Function for restoring the state of all simulations (One copy per field and simulation)
+def restore(arrays):
+    shapes = {
+        "positions": (batch_size, types, capacity, 2),
+        "velocities": (batch_size, types, capacity, 2),
+        "alive": (batch_size, types, capacity)
+        }
+    for name, field in state_fields.items():
+        shapes[name] = field.shape
+    
+    for name, shape in shapes.items():
+        if arrays[name].shape != shape:
+            raise ValueError(f"Snapshot field '{name}' has shape {arrays[name].shape}, expected {shape}")
+    
+    for name, field in state_fields.items():
+        field.from_numpy(np.ascontiguousarray(arrays[name]))
+    host_gravities[:] = [float(gravity) for gravity in arrays["gravities"]]
+    for b in range(batch_size):
+        load_simulation(b,
+            np.ascontiguousarray(arrays["positions"][b], dtype=np_state_float),
+            np.ascontiguousarray(arrays["velocities"][b], dtype=np_state_float),
+            np.ascontiguousarray(arrays["alive"][b], dtype=np.int32),
+            np.ascontiguousarray(arrays["forces"][b]))
+
+
+# Function for saving the state of all simulations. A path ending with '.npz' gives one file,
+# otherwise a folder of '.npy' files is written, which can be loaded memory-mapped
+def save_snapshot(path, extra=None):
+    arrays = snapshot()
+    if extra is not None:
+        arrays.update(extra)
+    
+    if path.endswith(".npz"):
+        # Written to a temporary file first, so a crash never leaves half a snapshot
+        temp_path = path[:-4] + ".tmp.npz"
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+        return
+    
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+
+
+# Function for loading a snapshot saved by 'save_snapshot'. Returns all saved arrays
+def load_snapshot(path):
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+    else:
+        arrays = {}
+        for file in os.listdir(path):
+            if file.endswith(".npy"):
+                arrays[file[:-4]] = np.load(os.path.join(path, file), mmap_mode="r")
+    
+    restore(arrays)
+    return arrays
+
+
+# Function for the force from one particle on another (Food within eat range gives no force)
+@ti.func
+def pair_force(b, i, j, iOther, jOther, pos1):
+    force = ti.Vector([0.0, 0.0])
+    
+    # Particles does not interact with food before cooldown
+    cooldown = has_food[b] and i == 0 and iOther == 1 and tick_count[b] < food_cooldown
+    
+    # Only alive particles that are not the same particle interact
+    if not cooldown and alive_at(b, iOther, jOther) and (i != iOther or j != jOther):
+        dir = ti.cast(positions[b, iOther, jOther] - pos1, float)  # Vector from current to other particle (Forces use the default precision)
+        dist_sqr = dir.norm_sqr() + 1e-10
+        dist = ti.sqrt(dist_sqr)                # Distance between particles
+        
+        # Food within eat range of a main particle gives no force (It is eaten separately)
+        if has_food[b] and i == 0 and iOther == 1 and dist <= (40 * rad / width):
+            force = ti.Vector([0.0, 0.0])
+        
+        # Same type is repelled if within range
+        elif dist < (coll_range) * rad / width and i == iOther:
+            force = -coll_forces[b] * dir.normalized()
+            
+        # Otherwise apply the defined force
+        else:
+            force = force_mult * forces[b, i, iOther] * dir.normalized()
+    
+    return force
+
+
+# Function for applying accumulated force, speed limit and gravity to a particle
+@ti.func
+def apply_force(b, i, j, force_acc, config: ti.template()):
+    max_speed = max_speeds[b]
+    gravity = gravities[b]
+    
+    # If force_acc is NAN then set as [0, 0] to avoid errors
+    if ti.math.isnan(force_acc.x) or ti.math.isnan(force_acc.y):
+        force_acc = ti.Vector([0.0, 0.0])
+    
+    # Apply force to accumulate velocity (For the step size of the adaptive integrator)
+    if ti.static(config.adaptive):
+        velocities[b, i, j] += force_acc / width * dt[b]
+    else:
+        velocities[b, i, j] += force_acc / width
+    
+    # Keep velocity within max_speed
+    speed = velocities[b, i, j].norm()
+    if speed > max_speed:
+        velocities[b, i, j] = velocities[b, i, j].normalized() * max_speed
     
-    # Use highest highest amount value
+    # Apply gravity force (Not compiled without gravity)
+    if ti.static(config.gravity):
+        step = 1.0
+        if ti.static(config.adaptive):
+            step = dt[b]
+        velocities[b, i, j] += ti.Vector([0.0, -gravity*0.015]) * step
+        
+        # Food has additional gravity to right stay in place
+        if ti.static(config.food):
+            if has_food[b] and i == 1:
+                velocities[b, i, j] += ti.Vector([gravity*0.015, 0.0]) * step
+
+
+# Function for the highest amount value (Food is always looped through, and no type has more than
+# 'capacity' particles, so the species of the box map only loop through their share)
+@ti.func
+def loop_amount(particle_amount):
     amount = particle_amount
     if particle_amount < foodAmount:
         amount = foodAmount
+    return min(amount, capacity)
+
+
+# Function for rebuilding the lists of alive particles of the simulations where particles died
+# (Parallel prefix sum of the alive flags over blocks of 'scan_block' particles, used inside kernels)
+@ti.func
+def compact_live_step(amount):
+    blocks = (amount + scan_block - 1) // scan_block
+    
+    # Count alive particles of each block
+    for b, i, block in ti.ndrange(batch_size, types, blocks):
+        if live_dirty[b]:
+            count = 0
+            for j in range(block * scan_block, min((block + 1) * scan_block, amount)):
+                if alive_at(b, i, j):
+                    count += 1
+            live_block_start[b, i, block] = count
+    
+    # Prefix sum of the block counts gives the start of each block in the list
+    for b, i in ti.ndrange(batch_size, types):
+        if live_dirty[b]:
+            total = 0
+            for block in range(blocks):
+                count = live_block_start[b, i, block]
+                live_block_start[b, i, block] = total
+                total += count
+            live_count[b, i] = total
+    
+    # Every block places its alive particles in order
+    for b, i, block in ti.ndrange(batch_size, types, blocks):
+        if live_dirty[b]:
+            k = live_block_start[b, i, block]
+            for j in range(block * scan_block, min((block + 1) * scan_block, amount)):
+                if alive_at(b, i, j):
+                    live_ids[b, i, k] = j
+                    k += 1
+    
+    for b in range(batch_size):
+        live_dirty[b] = False
+
+
+# Function for rebuilding the lists of alive particles
+@ti.kernel
+def compact_live(particle_amount: int):
+    compact_live_step(loop_amount(particle_amount))
+
+
+# Function for copying the positions of the alive particles into the order of the lists, so the
+# particles of a tile are next to each other in memory (Used inside kernels)
+@ti.func
+def gather_live_step(amount, loop_types: ti.template()):
+    for b, i, k in ti.ndrange(batch_size, loop_types, amount):
+        if k < live_count[b, i]:
+            live_pos[b, i, k] = positions[b, i, live_ids[b, i, k]]
+
+
+# Function for updating all particle velocities (One tick, used inside kernels).
+# Only the alive particles of the lists are looped through, in tiles of sources of each type.
+# Forces and conditions of a pair of types are looked up once per type instead of for every pair.
+# Only the types and food rules of the kernel configuration are compiled
+@ti.func
+def update_vel_step(amount, config: ti.template()):
+    gather_live_step(amount, config.types)
+    if ti.static(shared_tiles):
+        update_vel_shared_step(amount, config)
+    else:
+        update_vel_blocks_step(amount, config)
+
+
+# Function for updating all particle velocities with blocks of targets (Used inside kernels). Every
+# thread takes a block of targets, so a tile is loaded once for the whole block
+@ti.func
+def update_vel_blocks_step(amount, config: ti.template()):
+    blocks = (amount + target_block - 1) // target_block
+    eat_range = 40 * rad / width
+    coll_dist = coll_range * rad / width
+    
+    # Loop though blocks of alive particles of all simulations
+    for b, i, block in ti.ndrange(batch_size, config.types, blocks):
         
-    # Loop though all particles
-    for i, j in ti.ndrange(types, amount):
-        
-        # Skip dead particles
-        if alive[i, j] == False:
+        # Skip simulations that reached their target time
+        if stopped(b, config):
             continue
         
-        force_acc = ti.Vector([0.0, 0.0])
-        pos1 = positions[i, j]
-
-        # Loop though all particles
-        for iOther, jOther in ti.ndrange(types, amount):
+        first = block * target_block
+        last = min(first + target_block, live_count[b, i])
+        
+        # Forces of the block are accumulated in the order of the lists
+        for k in range(first, last):
+            accelerations[b, i, k] = ti.Vector([0.0, 0.0])
+        
+        for iOther in range(config.types):
+            # Conditions of the pair of types. Particles does not interact with food before cooldown
+            same = i == iOther
+            attraction = force_mult * forces[b, i, iOther]
+            repulsion = coll_forces[b]
+            eats = False
+            if ti.static(config.food):
+                eats = has_food[b] and i == 0 and iOther == 1
+                if eats and tick_count[b] < food_cooldown:
+                    continue
             
-            # Particles does not interact with food before cooldown
-            if i == 0 and iOther == 1 and tickCount < 300:
-                continue
+            # Loop through the tiles of the other type
+            for tile in range((live_count[b, iOther] + tile_size - 1) // tile_size):
+                start = tile * tile_size
+                end = min(start + tile_size, live_count[b, iOther])
+                for k in range(first, last):
+                    pos1 = live_pos[b, i, k]
+                    force_acc = accelerations[b, i, k]
+                    
+                    for kOther in range(start, end):
+                        # Particles do not interact with themselves
+                        if same and kOther == k:
+                            continue
+                        
+                        dir = ti.cast(live_pos[b, iOther, kOther] - pos1, float)  # Vector from current to other particle (Forces use the default precision)
+                        dist_sqr = dir.norm_sqr() + 1e-10
+                        dist = ti.sqrt(dist_sqr)                # Distance between particles
+                        
+                        # Same type is repelled if within range, otherwise the defined force applies
+                        # (Selected without branches, so the loop can be vectorized)
+                        scale = attraction
+                        if same and dist < coll_dist:
+                            scale = -repulsion
+                        
+                        # Food is eaten if main particle type is within range. It is only marked and removed
+                        # after the update, and gives no force
+                        if ti.static(config.food):
+                            if eats and dist <= eat_range:
+                                eaten_mark[b, live_ids[b, iOther, kOther]] = True
+                                scale = 0.0
+                        
+                        force_acc += scale * dir.normalized()
+                    
+                    accelerations[b, i, k] = force_acc
+        
+        for k in range(first, last):
+            apply_force(b, i, live_ids[b, i, k], accelerations[b, i, k], config)
+
+
+# Function for updating all particle velocities with tiles in shared memory (GPU only, used inside kernels).
+# Every block of 'tile_size' threads takes targets of the same type and simulation (The amount is padded
+# to whole blocks), and its threads load each tile of sources into shared memory together. All threads
+# of a block reach the same syncs: padding threads and stopped simulations still help loading
+@ti.func
+def update_vel_shared_step(amount, config: ti.template()):
+    padded = (amount + tile_size - 1) // tile_size * tile_size
+    eat_range = 40 * rad / width
+    coll_dist = coll_range * rad / width
+    
+    ti.loop_config(block_dim=tile_size)
+    for b, i, k in ti.ndrange(batch_size, config.types, padded):
+        tile_pos = ti.simt.block.SharedArray((tile_size, 2), state_float)
+        thread = k % tile_size
+        target = k < live_count[b, i] and not stopped(b, config)
+        pos1 = ti.Vector([0.0, 0.0], dt=state_float)
+        if target:
+            pos1 = live_pos[b, i, k]
+        force_acc = ti.Vector([0.0, 0.0])
+        
+        for iOther in range(config.types):
+            # Conditions of the pair of types. Particles does not interact with food before cooldown
+            same = i == iOther
+            attraction = force_mult * forces[b, i, iOther]
+            repulsion = coll_forces[b]
+            eats = False
+            tiles = (live_count[b, iOther] + tile_size - 1) // tile_size
+            if ti.static(config.food):
+                eats = has_food[b] and i == 0 and iOther == 1
+                if eats and tick_count[b] < food_cooldown:
+                    tiles = 0
             
-            # Skip dead particles
-            if alive[iOther, jOther] == False:
+            # Loop through the tiles of the other type (The same tiles for all threads of the block)
+            for tile in range(tiles):
+                start = tile * tile_size
+                end = min(start + tile_size, live_count[b, iOther])
+                
+                # Wait until the last tile is used, then load the next one
+                ti.simt.block.sync()
+                if start + thread < end:
+                    source = live_pos[b, iOther, start + thread]
+                    tile_pos[thread, 0] = source.x
+                    tile_pos[thread, 1] = source.y
+                ti.simt.block.sync()
+                
+                if target:
+                    for t in range(end - start):
+                        kOther = start + t
+                        
+                        # Particles do not interact with themselves
+                        if same and kOther == k:
+                            continue
+                        
+                        other = ti.Vector([tile_pos[t, 0], tile_pos[t, 1]])
+                        dir = ti.cast(other - pos1, float)  # Vector from current to other particle (Forces use the default precision)
+                        dist_sqr = dir.norm_sqr() + 1e-10
+                        dist = ti.sqrt(dist_sqr)                # Distance between particles
+                        
+                        # Same type is repelled if within range, otherwise the defined force applies
+                        scale = attraction
+                        if same and dist < coll_dist:
+                            scale = -repulsion
+                        
+                        # Food is eaten if main particle type is within range. It is only marked and removed
+                        # after the update, and gives no force
+                        if ti.static(config.food):
+                            if eats and dist <= eat_range:
+                                eaten_mark[b, live_ids[b, iOther, kOther]] = True
+                                scale = 0.0
+                        
+                        force_acc += scale * dir.normalized()
+        
+        if target:
+            accelerations[b, i, k] = force_acc
+            apply_force(b, i, live_ids[b, i, k], force_acc, config)
+
+
+# Function for updating all particle velocities
+@ti.kernel
+def update_vel(particle_amount: int, config: ti.template()):
+    amount = loop_amount(particle_amount)
+    compact_live_step(amount)
+    update_vel_step(amount, config)
+
+
+# Function for the cell of a position in a grid with res x res cells
+@ti.func
+def cell_of(pos, res):
+    cx = max(0, min(int(pos.x * res), res - 1))
+    cy = max(0, min(int(pos.y * res), res - 1))
+    return cx, cy
+
+
+# Function for sorting all alive particles into the cells of a uniform grid (Used inside kernels). With
+# 'by_type' every type has its own cells (Type i uses the cells from i * res * res)
+@ti.func
+def sort_into_cells_step(amount, res, counts: ti.template(), offsets: ti.template(), sorted_ids: ti.template(), by_type: ti.template()):
+    cells = res * res
+    if ti.static(by_type):
+        cells = types * res * res
+    
+    # Clear cell counts
+    for b, c in ti.ndrange(batch_size, cells):
+        counts[b, c] = 0
+    
+    # Count particles in each cell and remember their position within the cell
+    for b, i, j in ti.ndrange(batch_size, types, amount):
+        if alive_at(b, i, j):
+            cx, cy = cell_of(positions[b, i, j], res)
+            c = cx * res + cy
+            if ti.static(by_type):
+                c += i * res * res
+            particle_cell[b, i, j] = c
+            particle_slot[b, i, j] = ti.atomic_add(counts[b, c], 1)
+    
+    # Prefix sum of counts gives the start of each cell
+    ti.loop_config(serialize=True)
+    for b, c in ti.ndrange(batch_size, cells):
+        if c == 0:
+            offsets[b, c] = 0
+        else:
+            offsets[b, c] = offsets[b, c - 1] + counts[b, c - 1]
+    
+    # Place particle ids (type * capacity + index) in the sorted list
+    for b, i, j in ti.ndrange(batch_size, types, amount):
+        if alive_at(b, i, j):
+            c = particle_cell[b, i, j]
+            sorted_ids[b, offsets[b, c] + particle_slot[b, i, j]] = i * capacity + j
+
+
+# Function for sorting all alive particles into the cells of a uniform grid
+@ti.kernel
+def sort_into_cells(particle_amount: int, res: int, counts: ti.template(), offsets: ti.template(), sorted_ids: ti.template()):
+    sort_into_cells_step(loop_amount(particle_amount), res, counts, offsets, sorted_ids, False)
+
+
+# Function for copying the positions of the particles sorted into a grid into the order of the cells, so the
+# particles of neighboring cells are next to each other in memory (Used inside kernels)
+@ti.func
+def gather_sorted_step(amount, cells, counts: ti.template(), offsets: ti.template(), sorted_ids: ti.template()):
+    last = cells - 1
+    for b, k in ti.ndrange(batch_size, types * amount):
+        if k < offsets[b, last] + counts[b, last]:
+            pid = sorted_ids[b, k]
+            sorted_pos[b, k] = positions[b, pid // capacity, pid % capacity]
+
+
+# Function for eating the food within range of a main particle (Used inside kernels). Only the few food
+# particles are checked. In deterministic runs food is only marked, so all particles see the same food during the update
+@ti.func
+def eat_food(b, pos1):
+    for jOther in range(foodAmount):
+        if alive_at(b, 1, jOther):
+            dir = ti.cast(positions[b, 1, jOther] - pos1, float)
+            if ti.sqrt(dir.norm_sqr() + 1e-10) <= (40 * rad / width):
+                if ti.static(deterministic):
+                    eaten_mark[b, jOther] = True
+                else:
+                    set_alive(b, 1, jOther, False)
+                    positions[b, 1, jOther] = [-1, 1]
+                    live_dirty[b] = True
+
+
+# Function for updating all particle velocities using only the neighboring grid cells (Used inside kernels).
+# Particles are looped through in the order of the cells, so neighboring threads read the same cells
+@ti.func
+def update_vel_grid_step(amount, config: ti.template()):
+    gather_sorted_step(amount, grid_res * grid_res, cell_count, cell_offset, cell_particles)
+    cutoff = max(interaction_cutoff, coll_range * rad / width)
+    coll_dist = coll_range * rad / width
+    eat_range = 40 * rad / width
+    last = grid_res * grid_res - 1
+    
+    # Loop though the sorted particles of all simulations
+    for b, k in ti.ndrange(batch_size, types * amount):
+        
+        # Skip simulations that reached their target time
+        if k >= cell_offset[b, last] + cell_count[b, last] or stopped(b, config):
+            continue
+        
+        pid = cell_particles[b, k]
+        i = pid // capacity
+        pos1 = sorted_pos[b, k]
+        force_acc = ti.Vector([0.0, 0.0])
+        
+        # Main particles does not interact with food before cooldown
+        feeds = False
+        cooldown = False
+        if ti.static(config.food):
+            feeds = has_food[b] and i == 0
+            cooldown = feeds and tick_count[b] < food_cooldown
+        
+        # Loop through the particles of the 3x3 neighboring cells (The 3 cells of a column are next to each other)
+        cx, cy = cell_of(pos1, grid_res)
+        for dx in range(-1, 2):
+            ncx = cx + dx
+            if ncx < 0 or ncx >= grid_res:
                 continue
             
-            # Continiue if not the same particle
-            if i != iOther or j != jOther:
-                dir = positions[iOther, jOther] - pos1  # Vector from current to other particle 
+            first = ncx * grid_res + max(cy - 1, 0)
+            end = ncx * grid_res + min(cy + 1, grid_res - 1)
+            for kOther in range(cell_offset[b, first], cell_offset[b, end] + cell_count[b, end]):
+                # Particles do not interact with themselves
+                if kOther == k:
+                    continue
+                
+                iOther = cell_particles[b, kOther] // capacity
+                dir = ti.cast(sorted_pos[b, kOther] - pos1, float)  # Vector from current to other particle (Forces use the default precision)
                 dist_sqr = dir.norm_sqr() + 1e-10
                 dist = ti.sqrt(dist_sqr)                # Distance between particles
                 
-                # Food is eaten if main particle type is within range
-                if i == 0 and iOther == 1 and dist <= (40 * rad / width):
-                    alive[iOther, jOther] = False
-                    positions[iOther, jOther] = [-1, 1]
-                    continue
-                
-                result_force = 0.0
+                # Same type is repelled if within range, otherwise the defined force applies within cutoff
+                scale = 0.0
+                if i == iOther and dist < coll_dist:
+                    scale = -coll_forces[b]
+                elif dist <= cutoff:
+                    scale = force_mult * forces[b, i, iOther]
                 
-                # Same type is repelled if within range
-                if dist < (coll_range) * rad / width and i == iOther:
-                    result_force = -coll_force
-                    
-                # Otherwise apply the defined force
-                else:
-                    result_force = force_mult * forces[i, iOther]
+                # Food within eat range gives no force
+                if ti.static(config.food):
+                    if feeds and iOther == 1 and (cooldown or dist <= eat_range):
+                        scale = 0.0
                 
-                # Accumulate the force in direction of other particle
-                endForce = result_force * dir.normalized()
-                force_acc += endForce
+                force_acc += scale * dir.normalized()
+        
+        if ti.static(config.food):
+            if feeds and not cooldown:
+                eat_food(b, pos1)
         
-        # If force_acc is NAN then set as [0, 0] to avoid errors
-        if ti.math.isnan(force_acc.x) or ti.math.isnan(force_acc.y):
-            force_acc = ti.Vector([0.0, 0.0])
+        apply_force(b, i, pid % capacity, force_acc, config)
+
+
+# Function for updating all particle velocities using only the neighboring grid cells
+@ti.kernel
+def update_vel_grid(particle_amount: int, config: ti.template()):
+    update_vel_grid_step(loop_amount(particle_amount), config)
+
+
+# Function for the first node of a quadtree level
+@ti.func
+def level_start(level):
+    return ((1 << (2 * level)) - 1) // 3
+
+
+# Function for the depth of the quadtree inside kernels (Same as 'tree_depth', but never deeper than the fields)
+@ti.func
+def tree_depth_step(amount):
+    depth = 1
+    while depth < bh_depth and amount > bh_leaf_size * (1 << (2 * depth)):
+        depth += 1
+    return depth
+
+
+# Function for building the quadtree of every particle type (Used inside kernels). Particles are also
+# sorted into the leaves like the grid
+@ti.func
+def build_tree_step(amount):
+    depth = tree_depth_step(amount)
+    sort_into_cells_step(amount, 1 << depth, leaf_count, leaf_offset, leaf_particles, True)
+    gather_sorted_step(amount, types << (2 * depth), leaf_count, leaf_offset, leaf_particles)
+    
+    # Clear the nodes of the used levels
+    for b, t, n in ti.ndrange(batch_size, types, level_start(depth + 1)):
+        node_count[b, t, n] = 0
+        node_pos_sum[b, t, n] = ti.Vector([0.0, 0.0])
+    
+    # Add every alive particle to the node containing it on each level
+    for b, i, j in ti.ndrange(batch_size, types, amount):
+        if alive_at(b, i, j):
+            pos = positions[b, i, j]
+            for level in range(depth + 1):
+                cx, cy = cell_of(pos, 1 << level)
+                n = level_start(level) + cx * (1 << level) + cy
+                ti.atomic_add(node_count[b, i, n], 1)
+                ti.atomic_add(node_pos_sum[b, i, n], pos)
+
+
+# Function for building the quadtree of every particle type
+@ti.kernel
+def build_tree(particle_amount: int):
+    build_tree_step(loop_amount(particle_amount))
+
+
+# Function for the forces of the Barnes-Hut quadtrees on all particles, with a tree of 'depth' levels (Used
+# inside kernels). The trees are traversed once for every leaf of every type, and the nodes found apply to all
+# particles of the leaf. Nodes that are far enough from the whole leaf for the opening angle are seen as all
+# particles in their center. Collision and food apply within a range, so a node is only approximated when it
+# lies entirely inside or entirely outside that range for the whole leaf. Leaves that are too close are computed
+# exactly. Forces are stored in the order of the leaves, and eating is checked separately
+@ti.func
+def barnes_hut_forces_step(depth, config: ti.template()):
+    coll_dist = coll_range * rad / width
+    eat_range = 40 * rad / width
+    leaf_res = 1 << depth
+    leaf_size = 1.0 / leaf_res
+    
+    # Loop through the leaves of every type of all simulations
+    for b, i, c in ti.ndrange(batch_size, types, leaf_res * leaf_res):
+        first = leaf_offset[b, i * leaf_res * leaf_res + c]
+        end = first + leaf_count[b, i * leaf_res * leaf_res + c]
         
-        # Apply force to accumulate velocity
-        velocities[i, j] += force_acc / width
+        # Skip empty leaves and simulations that reached their target time
+        if first == end or stopped(b, config):
+            continue
         
-        # Keep velocity within max_speed
-        speed = velocities[i, j].norm()
-        if speed > max_speed:
-            velocities[i, j] = velocities[i, j].normalized() * max_speed
+        for k in range(first, end):
+            sorted_force[b, k] = ti.Vector([0.0, 0.0])
         
-        # Apply gravity force
-        velocities[i, j] += ti.Vector([0.0, -gravity*0.015])
+        leaf_low = ti.Vector([c // leaf_res, c % leaf_res]) * leaf_size
+        leaf_high = leaf_low + leaf_size
         
-        # Food has additional gravity to right stay in place
-        if i == 1:
-            velocities[i, j] += ti.Vector([gravity*0.015, 0.0])
-   
+        # Traverse the tree of each particle type
+        for t in range(types):
+            # Conditions of the pair of types. Main particles does not interact with food before cooldown
+            same = i == t
+            eats = has_food[b] and i == 0 and t == 1
+            if eats and tick_count[b] < food_cooldown:
+                continue
+            attraction = force_mult * forces[b, i, t]
+            repulsion = coll_forces[b]
+            
+            # The nodes are visited depth first without a stack: an opened node continues with its first child,
+            # and a finished node with its next sibling (Or the next sibling of the first parent that has one)
+            level = 0
+            cx = 0
+            cy = 0
+            while True:
+                res = 1 << level
+                n = level_start(level) + cx * res + cy
+                cnt = node_count[b, t, n]
+                opened = False
+                
+                if cnt > 0:
+                    # Squared distances between the node and the leaf (Nearest and farthest points), and from
+                    # the center of the node to the leaf
+                    size = 1.0 / res
+                    low = ti.Vector([cx, cy]) * size
+                    high = low + size
+                    center = node_pos_sum[b, t, n] / cnt
+                    near = ti.max(low - leaf_high, leaf_low - high, 0.0).norm_sqr()
+                    far = ti.max(high - leaf_low, leaf_high - low).norm_sqr()
+                    center_near = ti.max(leaf_low - center, center - leaf_high, 0.0).norm_sqr()
+                    
+                    # The whole node is inside or outside the range of collision (Same type) or eating (Food) for the whole leaf
+                    inside = False
+                    outside = True
+                    if same:
+                        inside = far < coll_dist * coll_dist
+                        outside = near >= coll_dist * coll_dist
+                    elif eats:
+                        inside = far <= eat_range * eat_range
+                        outside = near > eat_range * eat_range
+                    
+                    # Far nodes are seen as all particles in the center of the node
+                    if near > 0.0 and size * size < bh_theta * bh_theta * center_near and (inside or outside):
+                        scale = attraction
+                        if same and inside:
+                            scale = -repulsion
+                        elif eats and inside:
+                            scale = 0.0
+                        for k in range(first, end):
+                            dir = ti.cast(center - sorted_pos[b, k], float)
+                            sorted_force[b, k] += scale * cnt * dir.normalized()
+                    
+                    # Leaves are computed exactly (Selected without branches, so the loop can be vectorized)
+                    elif level == depth:
+                        other = t * leaf_res * leaf_res + cx * res + cy
+                        for k in range(first, end):
+                            pos1 = sorted_pos[b, k]
+                            force_acc = ti.Vector([0.0, 0.0])
+                            for kOther in range(leaf_offset[b, other], leaf_offset[b, other] + leaf_count[b, other]):
+                                dir = ti.cast(sorted_pos[b, kOther] - pos1, float)  # Vector from current to other particle (Forces use the default precision)
+                                dist = ti.sqrt(dir.norm_sqr() + 1e-10)
+                                scale = attraction
+                                if same and dist < coll_dist:
+                                    scale = -repulsion
+                                if eats and dist <= eat_range:
+                                    scale = 0.0
+                                
+                                # Particles do not interact with themselves
+                                if kOther == k:
+                                    scale = 0.0
+                                force_acc += scale / dist * dir
+                            
+                            sorted_force[b, k] += force_acc
+                    
+                    # Otherwise visit the 4 children
+                    else:
+                        opened = True
+                
+                if opened:
+                    level += 1
+                    cx *= 2
+                    cy *= 2
+                else:
+                    # Children are visited in the order (0, 0), (0, 1), (1, 0), (1, 1)
+                    while level > 0 and cx % 2 == 1 and cy % 2 == 1:
+                        level -= 1
+                        cx //= 2
+                        cy //= 2
+                    if level == 0:
+                        break
+                    if cy % 2 == 0:
+                        cy += 1
+                    else:
+                        cx += 1
+                        cy -= 1
 
-# Function to move particles on valley map
-@ti.kernel
-def move_valley(particle_amount: int):
-    # Use highest highest amount value
-    amount = particle_amount
-    if particle_amount < foodAmount:
-        amount = foodAmount
+
+# Function for updating all particle velocities using the Barnes-Hut quadtrees (Used inside kernels)
+@ti.func
+def update_vel_barnes_hut_step(amount, config: ti.template()):
+    depth = tree_depth_step(amount)
+    barnes_hut_forces_step(depth, config)
+    last = (types << (2 * depth)) - 1
+    
+    # Loop though the sorted particles of all simulations
+    for b, k in ti.ndrange(batch_size, types * amount):
         
-    # Loop through all particles
-    for i, j in ti.ndrange(types, amount):
+        # Skip simulations that reached their target time
+        if k >= leaf_offset[b, last] + leaf_count[b, last] or stopped(b, config):
+            continue
         
-        # Skip dead particles
-        if alive[i, j] == False:
-                continue
+        pid = leaf_particles[b, k]
+        i = pid // capacity
         
-        # Old position and initial new position
-        oldPos = positions[i, j]
-        newPos = positions[i, j] + velocities[i, j]
-        vel = velocities[i, j]
+        # Food is eaten separately
+        if ti.static(config.food):
+            if has_food[b] and i == 0 and tick_count[b] >= food_cooldown:
+                eat_food(b, sorted_pos[b, k])
         
-        # Particle dies when bottom of valley is touched
-        if newPos.y < 0.01:
-            alive[i, j] = False
-            positions[i, j] = [-1, 1]
-            continue
+        apply_force(b, i, pid % capacity, sorted_force[b, k], config)
 
-        # The following keeps particles withing the map:
-        
-        # When in the valley:
-        if oldPos.x >= boxWidth and oldPos.x <= 1-boxWidth and oldPos.y < boxHeight:
-            positions[i, j] = ti.Vector([
-                max(boxWidth, min(newPos.x, 1-boxWidth)), 
-                max(0.0, min(newPos.y, 1.0))
+
+# Function for updating all particle velocities using the Barnes-Hut quadtrees
+@ti.kernel
+def update_vel_barnes_hut(particle_amount: int, config: ti.template()):
+    update_vel_barnes_hut_step(loop_amount(particle_amount), config)
+
+
+# Function for removing food marked as eaten (Used inside kernels)
+@ti.func
+def resolve_eating_step():
+    for b, j in eaten_mark:
+        if eaten_mark[b, j]:
+            set_alive(b, 1, j, False)
+            positions[b, 1, j] = [-1, 1]
+            eaten_mark[b, j] = False
+            live_dirty[b] = True
+
+
+# Function for removing food marked as eaten
+@ti.kernel
+def resolve_eating():
+    resolve_eating_step()
+
+
+# Function for updating all particle velocities with the engine of the kernel configuration (Used inside kernels)
+@ti.func
+def update_velocities_step(amount, config: ti.template()):
+    if ti.static(config.engine == "grid"):
+        sort_into_cells_step(amount, grid_res, cell_count, cell_offset, cell_particles, False)
+        update_vel_grid_step(amount, config)
+    elif ti.static(config.engine == "barnes_hut"):
+        build_tree_step(amount)
+        update_vel_barnes_hut_step(amount, config)
+    else:
+        update_vel_step(amount, config)
+    
+    # The "exact" engine always marks eaten food
+    if ti.static(config.food and (deterministic or config.engine == "exact")):
+        resolve_eating_step()
+
+
+# Function for updating all particle velocities with the engine of the kernel configuration
+# (particle_amount is the highest amount of main particles in the batch).
+# Without a kernel configuration, the kernels work for both maps
+def update_velocities(particle_amount, config=None):
+    if config is None:
+        config = kernel_config()
+    
+    if config.engine == "grid":
+        sort_into_cells(particle_amount, grid_res, cell_count, cell_offset, cell_particles)
+        update_vel_grid(particle_amount, config)
+    elif config.engine == "barnes_hut":
+        build_tree(particle_amount)
+        update_vel_barnes_hut(particle_amount, config)
+    else:
+        update_vel(particle_amount, config)
+    
+    # The "exact" engine always marks eaten food
+    if config.food and (deterministic or config.engine == "exact"):
+        resolve_eating()
+
+
+# Function for computing the force on all particles without changing the simulation
+@ti.kernel
+def compute_accelerations(particle_amount: int, use_tree: ti.template()):
+    amount = loop_amount(particle_amount)
+    
+    for b, i, j in ti.ndrange(batch_size, types, amount):
+        force_acc = ti.Vector([0.0, 0.0])
+        if alive_at(b, i, j) and not ti.static(use_tree):
+            pos1 = positions[b, i, j]
+            for iOther in range(types):
+                for jOther in range(amount):
+                    force_acc += pair_force(b, i, j, iOther, jOther, pos1)
+        accelerations[b, i, j] = force_acc / width
+    
+    # The forces of the quadtrees are stored in the order of the leaves
+    if ti.static(use_tree):
+        depth = tree_depth_step(amount)
+        barnes_hut_forces_step(depth, ti.static(measure_config))
+        last = (types << (2 * depth)) - 1
+        for b, k in ti.ndrange(batch_size, types * amount):
+            if k < leaf_offset[b, last] + leaf_count[b, last]:
+                pid = leaf_particles[b, k]
+                accelerations[b, pid // capacity, pid % capacity] = sorted_force[b, k] / width
+
+
+# Function for the error of the Barnes-Hut accelerations compared to the exact ones
+# Returns mean and max error relative to the mean exact acceleration
+def barnes_hut_drift(particle_amount):
+    amount = max(particle_amount, foodAmount)
+    
+    compute_accelerations(particle_amount, False)
+    exact = accelerations.to_numpy()[:, :, :amount]
+    
+    build_tree(particle_amount)
+    compute_accelerations(particle_amount, True)
+    approx = accelerations.to_numpy()[:, :, :amount]
+    
+    # Only alive particles are compared
+    mask = alive_to_numpy()[:, :, :amount]
+    if not mask.any():
+        return 0.0, 0.0
+    scale = np.linalg.norm(exact[mask], axis=1).mean() + 1e-12
+    error = np.linalg.norm(approx[mask] - exact[mask], axis=1) / scale
+    return error.mean(), error.max()
+
+
+# Function for how far a particle moves in one step (Used inside kernels). The adaptive integrator
+# moves it for 'dt' ticks, but never further than 'cfl' of the collision range
+@ti.func
+def displacement(b, vel, config: ti.template()):
+    move = vel
+    if ti.static(config.adaptive):
+        move = vel * dt[b]
+        limit = cfl * coll_range * rad / width
+        length = move.norm()
+        if length > limit:
+            move *= limit / length
+    return move
+
+
+# Function for the step size of every simulation (Used inside kernels). The fastest particle moves
+# at most 'cfl' of the collision range, a step is never longer than 'dt_max' ticks, and a simulation
+# stops (dt = 0) when it has reached its target time
+@ti.func
+def compute_dt_step(amount, config: ti.template()):
+    for b in range(batch_size):
+        speed_max[b] = 0.0
+    
+    # Speed of the fastest alive particle of every simulation
+    for b, i, k in ti.ndrange(batch_size, config.types, amount):
+        if k < live_count[b, i]:
+            ti.atomic_max(speed_max[b], ti.cast(velocities[b, i, live_ids[b, i, k]].norm(), float))
+    
+    for b in range(batch_size):
+        step = dt_max
+        if speed_max[b] > 0:
+            step = min(step, cfl * coll_range * rad / width / speed_max[b])
+        remaining = target_time[b] - sim_time[b]
+        if remaining < 1e-3 or finished[b]:
+            step = 0.0
+        dt[b] = max(0.0, min(step, remaining))
+
+
+# Function for advancing the simulated time of every simulation by its step, or by one tick
+# with fixed ticks (Used inside kernels)
+@ti.func
+def advance_time_step(config: ti.template()):
+    for b in range(batch_size):
+        step = 1.0
+        if ti.static(config.adaptive):
+            step = dt[b]
+        if stopped(b, config):
+            step = 0.0
+        sim_time[b] += step
+        if step > 0:
+            integrator_steps[b] += 1
+
+
+# Function for adding the kinetic energy of a moved main particle to its simulation (Used inside kernels).
+# The energy is taken from the distance actually moved, since velocities stay high when particles are pushed
+# against walls or each other without moving
+@ti.func
+def add_motion(b, i, oldPos, newPos, config: ti.template()):
+    if ti.static(config.monitor and steady_window > 0):
+        if not (has_food[b] and i == 1):
+            speed_sqr = ti.cast((newPos - oldPos).norm_sqr(), float)
+            if ti.static(config.adaptive):
+                speed_sqr /= max(dt[b] * dt[b], 1e-12)
+            kinetic_energy[b] += 0.5 * speed_sqr
+
+
+# Function for finding the simulations that are finished (Used inside kernels, after the alive lists are rebuilt).
+# Reasons are only checked while a simulation is not finished, so the first reason is kept
+@ti.func
+def monitor_step(amount, config: ti.template()):
+    
+    for b in range(batch_size):
+        if not finished[b]:
+            food = 0
+            if has_food[b]:
+                food = live_count[b, 1]
+            
+            # Terminal state of the valley map (The reward can not change anymore). When all food is eaten,
+            # main particles can still fall into the valley, so that is only the end once it is steady
+            if has_food[b] and live_count[b, 0] == 0:
+                finished[b] = True
+                finish_reason[b] = 2
+            
+            # Steady state (Food can only be eaten after the cooldown)
+            if ti.static(steady_window > 0):
+                main = 0
+                for i in range(config.types):
+                    if not (has_food[b] and i == 1):
+                        main += live_count[b, i]
+                
+                step = 1.0
+                if ti.static(config.adaptive):
+                    step = dt[b]
+                
+                calm = kinetic_energy[b] / max(1, main) < steady_energy * 0.5 * max_speeds[b] ** 2 and food == last_food[b]
+                if has_food[b] and tick_count[b] < food_cooldown:
+                    calm = False
+                if calm:
+                    calm_time[b] += step
+                else:
+                    calm_time[b] = 0.0
+                last_food[b] = food
+                
+                if not finished[b] and calm_time[b] >= steady_window:
+                    finished[b] = True
+                    finish_reason[b] = 3
+                    if has_food[b] and food == 0:
+                        finish_reason[b] = 1
+                
+                # Energy of the next tick is added by the movement
+                kinetic_energy[b] = 0.0
+            
+            if finished[b]:
+                finished_at[b] = ti.cast(sim_time[b], int)
+
+
+# Function for the step size of every simulation
+@ti.kernel
+def compute_dt(particle_amount: int, config: ti.template()):
+    compute_dt_step(loop_amount(particle_amount), config)
+
+
+# Function for advancing the simulated time of every simulation
+@ti.kernel
+def advance_time(config: ti.template()):
+    advance_time_step(config)
+
+
+# Function for finding the simulations that are finished
+@ti.kernel
+def monitor(particle_amount: int, config: ti.template()):
+    monitor_step(loop_amount(particle_amount), config)
+
+
+# Function for moving the target time of every simulation N ticks ahead
+@ti.kernel
+def set_target_time(ticks: float):
+    for b in range(batch_size):
+        target_time[b] += ticks
+
+
+# Function for the number of simulations that have not reached their target time (Or are finished)
+@ti.kernel
+def simulations_running() -> int:
+    running = 0
+    for b in range(batch_size):
+        if target_time[b] - sim_time[b] >= 1e-3 and not finished[b]:
+            running += 1
+    return running
+
+
+# Function for whether simulation b is finished or has reached its target time, and does not move (Used inside kernels)
+@ti.func
+def stopped(b, config: ti.template()):
+    result = False
+    if ti.static(config.monitor):
+        result = finished[b]
+    if ti.static(config.adaptive):
+        result = result or dt[b] == 0
+    return result
+
+
+# Function to move particles on valley map (One tick, used inside kernels)
+@ti.func
+def move_valley_step(amount, config: ti.template()):
+        
+    # Loop through all alive particles of all simulations
+    for b, i, k in ti.ndrange(batch_size, types, amount):
+        if k >= live_count[b, i]:
+            continue
+        j = live_ids[b, i, k]
+        
+        # Skip particles eaten during this tick, and finished simulations
+        if not alive_at(b, i, j) or stopped(b, config):
+                continue
+        
+        # Old position and initial new position
+        oldPos = positions[b, i, j]
+        newPos = positions[b, i, j] + displacement(b, velocities[b, i, j], config)
+        vel = velocities[b, i, j]
+        
+        # Particle dies when bottom of valley is touched
+        if newPos.y < 0.01:
+            set_alive(b, i, j, False)
+            positions[b, i, j] = [-1, 1]
+            live_dirty[b] = True
+            continue
+
+        # The following keeps particles withing the map:
+        
+        # When in the valley:
+        if oldPos.x >= boxWidth and oldPos.x <= 1-boxWidth and oldPos.y < boxHeight:
+            positions[b, i, j] = ti.Vector([
+                max(boxWidth, min(newPos.x, 1-boxWidth)), 
+                max(0.0, min(newPos.y, 1.0))
             ])
             
         # When above one of the boxes
         elif oldPos.x < boxWidth or oldPos.x > 1-boxWidth:
-            positions[i, j] = ti.Vector([
+            positions[b, i, j] = ti.Vector([
                 max(0.0, min(newPos.x, 1.0)), 
                 max(boxHeight, min(newPos.y, 1.0))
             ])
             
             # Bounce on box
-            if vel.y < 0 and oldPos.y > boxHeight and positions[i, j].y == boxHeight:
-                velocities[i, j] = ti.Vector([
+            if vel.y < 0 and oldPos.y > boxHeight and positions[b, i, j].y == boxHeight:
+                velocities[b, i, j] = ti.Vector([
                     vel.x,
                     -1*vel.y
                 ])
         
         # Otherwise keep withing screen
         else:
-            positions[i, j] = ti.Vector([
+            positions[b, i, j] = ti.Vector([
                 max(0.0, min(newPos.x, 1.0)), 
                 max(0.0, min(newPos.y, 1.0))
             ])
+        
+        add_motion(b, i, oldPos, positions[b, i, j], config)
   
-# Function to move particles on box map        
+# Function to move particles on valley map
 @ti.kernel
-def move_box(amount: int):
+def move_valley(particle_amount: int, config: ti.template()):
+    amount = loop_amount(particle_amount)
+    compact_live_step(amount)
+    move_valley_step(amount, config)
+
+
+# Function to move particles on box map (One tick, used inside kernels)
+@ti.func
+def move_box_step(amount, config: ti.template()):
     
-    # Loop through all particles
-    for j in ti.ndrange(amount):
+    # Loop through all alive particles of all species and simulations
+    for b, i, k in ti.ndrange(batch_size, species, amount):
+        if k >= live_count[b, i]:
+            continue
+        j = live_ids[b, i, k]
+        
+        # Skip finished simulations
+        if stopped(b, config):
+            continue
         
         # Old position and initial new position
-        oldPos = positions[0, j]
-        newPos = positions[0, j] + velocities[0, j]
-        vel = velocities[0, j]
+        oldPos = positions[b, i, j]
+        newPos = positions[b, i, j] + displacement(b, velocities[b, i, j], config)
+        vel = velocities[b, i, j]
         
         # Keep withing screen
-        positions[0, j] = ti.Vector([
+        positions[b, i, j] = ti.Vector([
                 max(0.0, min(newPos.x, 1.0)), 
                 max(0.0, min(newPos.y, 1.0))
         ])
         
         # Bounce on floor
-        if vel.y < 0 and oldPos.y > 0 and positions[0, j].y == 0.0:
-            velocities[0, j] = ti.Vector([
+        if vel.y < 0 and oldPos.y > 0 and positions[b, i, j].y == 0.0:
+            velocities[b, i, j] = ti.Vector([
                     vel.x,
                     -1*vel.y
                 ])
+        
+        add_motion(b, i, oldPos, positions[b, i, j], config)
+
+
+# Function to move particles on box map
+@ti.kernel
+def move_box(particle_amount: int, config: ti.template()):
+    amount = loop_amount(particle_amount)
+    compact_live_step(amount)
+    move_box_step(amount, config)
+
+
+# Function for filling the render fields that never change (Colors and box outlines)
+def setup_render_fields():
+    rgb = np.zeros((types * capacity, 3), dtype=np_float)
+    for i in range(types):
+        color = colors[i]
+        rgb[i * capacity: (i + 1) * capacity] = [(color >> 16 & 0xff) / 255, (color >> 8 & 0xff) / 255, (color & 0xff) / 255]
+    render_colors.from_numpy(rgb)
+    
+    lines = []
+    for left, right in [(0, boxWidth), (1-boxWidth, 1)]:
+        corners = [[left, 0], [right, 0], [right, boxHeight], [left, boxHeight]]
+        for k in range(4):
+            lines += [corners[k], corners[(k + 1) % 4]]
+    box_vertices.from_numpy(np.array(lines, dtype=np_float))
+
+
+# Function for copying the first simulation into the vertex fields of the GGUI renderer (Stays on the device).
+# Dead particles get radius 0 and are not drawn
+@ti.kernel
+def prepare_frame():
+    for i, j in ti.ndrange(types, capacity):
+        k = i * capacity + j
+        render_positions[k] = positions[0, i, j]
+        render_radius[k] = 0.0
+        if alive_at(0, i, j):
+            render_radius[k] = rad / height
+
+
+# Function for rendering with GGUI (Positions are never copied to the host)
+def render_ggui(hasValley):
+    window = get_gui()
+    canvas = window.get_canvas()
+    canvas.set_background_color((0.0, 0.0, 0.0))
+    
+    # Draw the two boxes if on valley map
+    if hasValley:
+        canvas.lines(box_vertices, width=1 / height, color=(0.667, 0.667, 0.667))
+    
+    # Draw all particles
+    prepare_frame()
+    canvas.circles(render_positions, radius=rad / height, per_vertex_color=render_colors, per_vertex_radius=render_radius)
+    
+    window.show()
+
+
+# Time of the last frame of the regular simulation
+last_frame = 0.0
 
 
-# Function for rendering / drawing
+# Function for checking if the regular simulation should draw a frame (Limits the frame rate to --fps,
+# while the simulation keeps running between frames)
+def frame_due():
+    global last_frame
+    now = time.perf_counter()
+    if args.fps > 0 and now - last_frame < 1 / args.fps:
+        return False
+    last_frame = now
+    return True
+
+
+# Function for rendering / drawing (Shows the first simulation of the batch)
 def render(hasValley):
+    with timed("render"):
+        render_frame(hasValley)
+
+
+# Function for drawing a frame with the selected renderer
+def render_frame(hasValley):
+    gui = get_gui()
+    if renderer == "ggui":
+        render_ggui(hasValley)
+        return
         
     # Numpy with all particles
-    np_pos = positions.to_numpy().reshape(-1, 2)
+    np_pos = positions.to_numpy()[0]
     
     # Draw the two boxes if on valley map
     if hasValley:
@@ -257,404 +1880,2419 @@ def render(hasValley):
 
     # Draw all particles
     for i in range(types):
-        gui.circles(np_pos[i * glob_amount: (i + 1) * glob_amount], radius=rad, color=colors[i])
+        gui.circles(np_pos[i, :type_capacities[i]], radius=rad, color=colors[i])
     
     # Show the GUI
     gui.show()
 
 
-# Function checks if a particle touches roof of a box
-@ti.kernel
-def checkTouchGround(amount: int) -> bool:
-    hasTouched = False
-    
-    # Tests for all particle y-position
-    for j in range(amount):
-        if positions[0, j].y <= boxHeight + 0.01:
-            hasTouched = True
-    return hasTouched
+# Function for counting ticks in every simulation. Ticker starts after a particle touches roof of a box
+# (Used inside kernels)
+@ti.func
+def advance_ticks_step(amount, config: ti.template()):
+    
+    # Count ticks after contact (Whole ticks of the simulated time with the adaptive integrator)
+    for b in range(batch_size):
+        if touched_ground[b]:
+            if ti.static(config.adaptive):
+                ground_time[b] += dt[b]
+                tick_count[b] = int(ground_time[b])
+            else:
+                tick_count[b] += 1
+    
+    # Tests for all particle y-position
+    for b, j in ti.ndrange(batch_size, amount):
+        if not touched_ground[b] and alive_at(b, 0, j) and positions[b, 0, j].y <= boxHeight + 0.01:
+            touched_ground[b] = True
+
+
+# Function for counting ticks in every simulation
+@ti.kernel
+def advance_ticks(amount: int, config: ti.template()):
+    advance_ticks_step(amount, config)
+
+
+# Configuration a kernel is compiled for. Kernels only contain the code of their map, number of
+# types, gravity, food and engine, so the inner loops have no branches for the other cases:
+#   hasValley - map of the kernel (None = both maps)
+#   types     - number of particle types looped through (2 on the valley map, 'species' on the box map)
+#   gravity   - gravity is applied (Off when all simulations of the batch have no gravity)
+#   food      - food is eaten and has its own gravity (Only on the valley map)
+#   engine    - engine of the velocity update
+#   adaptive  - steps have the size 'dt' of the adaptive integrator instead of one tick
+#   monitor   - finished simulations are detected and stop moving (--early-stop)
+KernelConfig = collections.namedtuple("KernelConfig", ["hasValley", "types", "gravity", "food", "engine", "adaptive", "monitor"])
+measure_config = KernelConfig(None, 2, True, True, "exact", False, False)   # Kernels that only measure never skip simulations
+
+# Registry of the kernel configurations. Taichi compiles a kernel once for every configuration it is
+# called with and keeps it, so all trials with the same configuration reuse the compiled kernels
+kernel_configs = {}
+
+
+# Function for the kernel configuration of the current simulations on a map (None = both maps). The engine
+# and whether finished simulations stop ('monitor') are those of the command line unless they are given
+def kernel_config(hasValley=None, engine_name=None, monitor=None):
+    engine_name = engine if engine_name is None else engine_name
+    monitor = early_stop if monitor is None else monitor
+    if hasValley is None:
+        key = (None, types, True, True, engine_name, adaptive, monitor)
+    elif hasValley:
+        key = (True, 2, any(gravity != 0 for gravity in host_gravities), foodAmount > 0, engine_name, adaptive, monitor)
+    else:
+        key = (False, species, any(gravity != 0 for gravity in host_gravities), False, engine_name, adaptive, monitor)
+    
+    if key not in kernel_configs:
+        kernel_configs[key] = KernelConfig(*key)
+    return kernel_configs[key]
+
+
+# Function for running several ticks (Or adaptive steps) of all simulations in one kernel launch. Tick counter
+# and ground contact stay on the device, so nothing is synchronized with the host between ticks
+@ti.kernel
+def step_fused(ticks: ti.template(), particle_amount: int, config: ti.template()):
+    amount = loop_amount(particle_amount)
+    
+    for _ in ti.static(range(ticks)):
+        compact_live_step(amount)
+        if ti.static(config.monitor):
+            monitor_step(amount, config)
+        if ti.static(config.adaptive):
+            compute_dt_step(amount, config)
+        if ti.static(config.hasValley):
+            advance_ticks_step(particle_amount, config)
+            update_velocities_step(amount, config)
+            move_valley_step(amount, config)
+        else:
+            update_velocities_step(amount, config)
+            move_box_step(amount, config)
+        if ti.static(config.adaptive or config.monitor):
+            advance_time_step(config)
+
+
+# Function for running one tick (Or adaptive step) of all simulations with a kernel launch per stage
+# (Used with --profile-stages, so the kernel profiler can tell the stages apart)
+def step_unfused(amount, config):
+    compact_live(amount)
+    if config.monitor:
+        monitor(amount, config)
+    if config.adaptive:
+        compute_dt(amount, config)
+    if config.hasValley:
+        advance_ticks(amount, config)
+        update_velocities(amount, config)
+        move_valley(amount, config)
+    else:
+        update_velocities(amount, config)
+        move_box(amount, config)
+    if config.adaptive or config.monitor:
+        advance_time(config)
+
+
+# Function for running N ticks of all simulations. Ticks are launched in chunks of
+# 'fused_ticks' (Default 'ticks_per_launch', smaller chunks are powers of two, so few kernels are compiled).
+# The adaptive integrator instead runs steps until every simulation has simulated N more ticks
+def step_simulations(ticks, amount, hasValley, config=None, fused_ticks=None):
+    with timed("simulate"):
+        if config is None:
+            config = kernel_config(hasValley)
+        if fused_ticks is None:
+            fused_ticks = ticks_per_launch
+        if config.adaptive:
+            set_target_time(ticks)
+            while simulations_running() > 0:
+                if profile_stages:
+                    step_unfused(amount, config)
+                else:
+                    step_fused(fused_ticks, amount, config)
+            return
+        
+        if profile_stages:
+            for _ in range(ticks):
+                step_unfused(amount, config)
+            return
+        
+        chunk = fused_ticks
+        while ticks > 0:
+            while chunk > ticks:
+                chunk //= 2
+            step_fused(chunk, amount, config)
+            ticks -= chunk
+
+
+# Run function for valley map
+def run_valley():
+    
+    # Get physics variables
+    amount = 100
+    gravity = glob_gravity
+    max_speed = glob_max_speed
+    coll_force = glob_coll_force
+    
+    # Initialize (Ticker starts after a particle touches ground)
+    initValley(amount)
+    set_physics(0, gravity, max_speed, coll_force)
+    
+    # Export to images instead of drawing (Only with --export)
+    if args.export is not None:
+        export_simulation(amount, hasValley=True)
+        return
+    
+    # Recording of the simulation (Only with --record)
+    recorder = None
+    if args.record is not None:
+        recorder = Recorder(args.record, "valley")
+    
+    # Main execution loop
+    tick = 0
+    while get_gui().running:
+        if recorder is not None and tick % args.record_every == 0:
+            recorder.record(0, tick)
+        
+        # Count ticks after ground contact, update velocities and move all particles
+        step_simulations(1, amount, hasValley=True)
+        tick += 1
+        
+        # Draw all particles and map
+        if frame_due():
+            render(hasValley=True)
+    
+    if recorder is not None:
+        recorder.close()
+
+# Run function for box map
+def run_box():
+    
+    # Get physics variables
+    amount = glob_amount
+    gravity = glob_gravity
+    max_speed = glob_max_speed
+    coll_force = glob_coll_force
+    
+    # Initialize
+    initBox(amount)
+    set_physics(0, gravity, max_speed, coll_force)
+    
+    # Export to images instead of drawing (Only with --export)
+    if args.export is not None:
+        export_simulation(amount, hasValley=False)
+        return
+    
+    # Recording of the simulation (Only with --record)
+    recorder = None
+    if args.record is not None:
+        recorder = Recorder(args.record, "box")
+    
+    # Main execution loop
+    tick = 0
+    while get_gui().running:
+        if recorder is not None and tick % args.record_every == 0:
+            recorder.record(0, tick)
+        
+        # Update velocities and move alle particles
+        step_simulations(1, amount, hasValley=False)
+        tick += 1
+        
+        # Draw all particles and map
+        if frame_due():
+            render(hasValley=False)
+    
+    if recorder is not None:
+        recorder.close()
+
+
+# ================================================================
+#         Profiling
+# ================================================================
+
+
+wall_times = {}             # Host seconds of each timed section since the last reset
+kernel_times = {}           # Device seconds of each kernel since the last reset
+jit_seconds = 0.0           # Seconds spent compiling kernels since the last reset
+timed_stack = []            # Seconds of the sections timed inside each open section (Not counted twice)
+profiled_kernels = []       # Names of the kernels whose launches are watched when profiling
+compiled_configs = set()    # Kernel configurations launched since Taichi was started (Their first launch compiled them)
+launched_configs = {}       # Configuration of the last launch of each kernel since the profiler records were collected
+
+
+# Function for moving the records of the kernel profiler into 'kernel_times'. Records are named after the
+# compiled tasks (e.g. 'update_vel_c80_0_kernel_3_range_for'), and a query sums the tasks of one configuration
+# of a kernel, so the records are collected before a kernel is launched with another configuration.
+# Device time of no kernel of main.py (Field reads and writes, e.g. to_numpy) counts as "other"
+def collect_kernel_times():
+    seconds = ti.profiler.get_kernel_profiler_total_time()
+    kernel_seconds = 0.0
+    for name in profiled_kernels:
+        result = ti.profiler.query_kernel_profiler_info(name + "_c")
+        if result.counter > 0:
+            kernel_times[name] = kernel_times.get(name, 0.0) + result.counter * result.avg / 1000
+            kernel_seconds += result.counter * result.avg / 1000
+    if seconds - kernel_seconds > 1e-9:
+        kernel_times["other"] = kernel_times.get("other", 0.0) + seconds - kernel_seconds
+    ti.profiler.clear_kernel_profiler_info()
+    launched_configs.clear()
+
+
+# Function for watching the launches of a kernel when profiling. A configuration is the kernel with its
+# template arguments: its first launch compiles it (Or loads it from the offline cache), so the wall time
+# of the first launch that is not device time counts as compile time
+def profile_kernel(name, kernel):
+    parameters = inspect.signature(kernel).parameters.values()
+    templates = [i for i, parameter in enumerate(parameters) if isinstance(parameter.annotation, ti.template)]
+    
+    @functools.wraps(kernel)
+    def launch(*launch_args):
+        global jit_seconds
+        config = tuple(launch_args[i] for i in templates if i < len(launch_args))
+        if launched_configs.get(name, config) != config:
+            ti.sync()
+            collect_kernel_times()
+        launched_configs[name] = config
+        
+        if (name, config) in compiled_configs:
+            return kernel(*launch_args)
+        compiled_configs.add((name, config))
+        ti.sync()
+        device_start = ti.profiler.get_kernel_profiler_total_time()
+        start = time.perf_counter()
+        result = kernel(*launch_args)
+        ti.sync()
+        device_seconds = ti.profiler.get_kernel_profiler_total_time() - device_start
+        jit_seconds += max(0.0, time.perf_counter() - start - device_seconds)
+        return result
+    
+    return launch
+
+
+# Function for watching the launches of all kernels of main.py (Kernels have a 'grad' attribute, functions do not)
+def profile_kernels():
+    for name, value in list(globals().items()):
+        if callable(value) and hasattr(value, "grad"):
+            profiled_kernels.append(name)
+            globals()[name] = profile_kernel(name, value)
+
+
+# Function (Used as 'with timed(name):') for timing a section on the host. Waits for the device before
+# and after, so kernels count in the section that launched them. Sections timed inside another
+# section only count in the inner section (e.g. storage writes during the setup)
+@contextlib.contextmanager
+def timed(name):
+    if not profiling:
+        yield
+        return
+    
+    ti.sync()
+    collect_kernel_times()
+    start = time.perf_counter()
+    timed_stack.append(0.0)
+    try:
+        yield
+    finally:
+        ti.sync()
+        seconds = time.perf_counter() - start
+        collect_kernel_times()
+        inner_seconds = timed_stack.pop()
+        if timed_stack:
+            timed_stack[-1] += seconds
+        wall_times[name] = wall_times.get(name, 0.0) + seconds - inner_seconds
+
+
+# Function for writing an attribute of a trial to the storage (Timed as storage when profiling)
+def set_trial_attr(trial, key, value):
+    with timed("storage"):
+        trial.set_user_attr(key, value)
+
+
+# Function for clearing all times before a batch of trials
+def reset_profile():
+    global jit_seconds
+    if profiling:
+        collect_kernel_times()
+    wall_times.clear()
+    kernel_times.clear()
+    jit_seconds = 0.0
+
+
+# Function for storing the times of a batch of trials as trial attributes, and for streaming them as a
+# JSON line. All trials of a batch ran together, so they get the same times
+def store_profile(objective_name, trial_batch, started):
+    if not profiling:
+        return
+    
+    trial_seconds = time.perf_counter() - started
+    for trial in trial_batch:
+        ticks = trial.user_attrs.get("ticks_simulated", 0)
+        profile = {
+            "time_breakdown": {name: round(seconds, 6) for name, seconds in wall_times.items()},
+            "kernel_times": {name: round(seconds, 6) for name, seconds in sorted(kernel_times.items(), key=lambda item: -item[1])},
+            "jit_compile_seconds": round(jit_seconds, 6),
+            "trial_seconds": round(trial_seconds, 6),
+            "ticks_per_second": round(ticks / wall_times["simulate"], 2) if wall_times.get("simulate", 0) > 0 else 0.0,
+            "stepping": "unfused" if profile_stages else "fused",
+            "batch": len(trial_batch)
+            }
+        for key, value in profile.items():
+            trial.set_user_attr(key, value)
+        
+        if args.profile_stream is not None:
+            line = {"objective": objective_name, "trial": trial.number, "time": time.time(), **profile}
+            with open(args.profile_stream, "a") as file:
+                file.write(json.dumps(line) + "\n")
+
+
+# Function for storing the time of telling Optuna the values of a batch of trials. The trials are finished
+# by then, so the seconds are added to the study ("tell_seconds") and streamed as their own JSON line
+def store_tell_time(study, trial_batch, seconds):
+    study.set_user_attr("tell_seconds", study.user_attrs.get("tell_seconds", 0.0) + seconds)
+    
+    if args.profile_stream is not None:
+        line = {"study": study.study_name, "trials": [trial.number for trial in trial_batch], "time": time.time(), "tell_seconds": round(seconds, 6)}
+        with open(args.profile_stream, "a") as file:
+            file.write(json.dumps(line) + "\n")
+
+
+# ================================================================
+#         Recording, replay and export
+# ================================================================
+
+
+# Size of the header of a recording (JSON padded with spaces, followed by the frames)
+recording_header_size = 256
+
+
+# Function for copying the particles of simulation b into numpy arrays (Only one simulation is copied)
+@ti.kernel
+def read_frame(b: int, pos: ti.types.ndarray(), is_alive: ti.types.ndarray()):
+    for i, j in ti.ndrange(types, capacity):
+        pos[i, j, 0] = positions[b, i, j].x
+        pos[i, j, 1] = positions[b, i, j].y
+        is_alive[i, j] = ti.cast(alive_at(b, i, j), ti.u8)
+
+
+# Recorder appending frames of one simulation to a file. Frames are copied from the device on the
+# simulation thread and written by a background thread, so the simulation never waits for the disk
+class Recorder:
+    def __init__(self, path, map_name, start=0):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        
+        header = {"map": map_name, "types": types, "capacity": capacity, "every": args.record_every, "start": start}
+        self.file = open(path, "wb")
+        self.file.write(json.dumps(header).encode().ljust(recording_header_size))
+        
+        self.frames = queue.Queue()
+        self.thread = threading.Thread(target=self.write_frames, daemon=True)
+        self.thread.start()
+    
+    # Function for recording the current frame of simulation b (Never blocks)
+    def record(self, b, tick):
+        pos = np.empty((types, capacity, 2), dtype=np.float32)
+        is_alive = np.empty((types, capacity), dtype=np.uint8)
+        read_frame(b, pos, is_alive)
+        self.frames.put((pos, is_alive))
+    
+    # Function run by the background thread (Frames are only appended)
+    def write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            self.file.write(frame[0].tobytes())
+            self.file.write(frame[1].tobytes())
+        self.file.close()
+    
+    # Function for writing the remaining frames and closing the file
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+
+
+# Function for opening a recording. Returns the header and the frames, memory-mapped from the file
+# (A frame that is still being written is left out)
+def open_recording(path):
+    with open(path, "rb") as file:
+        header = json.loads(file.read(recording_header_size).decode())
+    
+    frame = np.dtype([
+        ("positions", np.float32, (header["types"], header["capacity"], 2)),
+        ("alive", np.uint8, (header["types"], header["capacity"]))
+        ])
+    count = (os.path.getsize(path) - recording_header_size) // frame.itemsize
+    if count == 0:
+        return header, np.zeros(0, dtype=frame)
+    return header, np.memmap(path, dtype=frame, mode="r", offset=recording_header_size, shape=(count,))
+
+
+# Function for showing a recorded frame in the first simulation
+def show_frame(frame):
+    pos, vel, is_alive, sim_forces = empty_simulation()
+    n_types = min(types, frame["alive"].shape[0])
+    n = min(capacity, frame["alive"].shape[1])
+    pos[:n_types, :n] = frame["positions"][:n_types, :n]
+    is_alive[:n_types, :n] = frame["alive"][:n_types, :n]
+    load_simulation(0, pos, vel, is_alive, sim_forces)
+
+
+# Function for the recording of a replay target (A file, or the name of a study to replay its best trial)
+def recording_path(target):
+    if os.path.exists(target):
+        return target
+    
+    study = optuna.load_study(study_name=target, storage=get_storage())
+    return study.best_trial.user_attrs.get("recording")
+
+
+# Function for replaying a recording without simulating it.
+# Space = play / pause, left / right = one frame back / forward, and the slider scrubs through the frames
+def replay(target):
+    path = recording_path(target)
+    if path is None or not os.path.exists(path):
+        print(f"No recording found for '{target}' (Record trials with --record-trials)")
+        return
+    
+    header, frames = open_recording(path)
+    if len(frames) == 0:
+        print(f"The recording '{path}' has no frames")
+        return
+    hasValley = header["map"] == "valley"
+    last = len(frames) - 1
+    
+    # Export every recorded frame instead of drawing (Only with --export)
+    if args.export is not None:
+        exporter = Exporter(args.export)
+        for frame in frames:
+            show_frame(frame)
+            exporter.add(0, hasValley)
+        exporter.close()
+        return
+    
+    gui = get_gui()
+    if renderer == "gui":
+        slider = gui.slider("Frame", 0, max(1, last), step=1)
+    
+    frame = 0
+    playing = True
+    while gui.running:
+        # Keyboard controls
+        for event in gui.get_events(ti.ui.PRESS if renderer == "ggui" else ti.GUI.PRESS):
+            if event.key == " ":
+                playing = not playing
+            elif event.key == "Left":
+                frame = max(0, frame - 1)
+                playing = False
+            elif event.key == "Right":
+                frame = min(last, frame + 1)
+                playing = False
+        
+        if not frame_due():
+            time.sleep(0.001)
+            continue
+        
+        # Scrubbing with the slider (The GGUI widgets are created once per shown frame)
+        if renderer == "ggui":
+            with gui.get_gui().sub_window("Replay", 0.01, 0.01, 0.3, 0.08) as window:
+                frame = window.slider_int("Frame", frame, 0, last)
+        elif int(slider.value) != frame:
+            frame = int(slider.value)
+        
+        show_frame(frames[frame])
+        if renderer == "gui":
+            slider.value = frame
+        render(hasValley)
+        
+        if playing:
+            frame = min(last, frame + 1)
+
+
+# Function for drawing simulation b into 'export_image' on the device (The same state always gives the same image)
+@ti.kernel
+def draw_frame(b: int, hasValley: ti.template()):
+    for x, y in export_ids:
+        export_ids[x, y] = 0
+    
+    # Every particle marks the pixels of its circle
+    for i, j in ti.ndrange(types, capacity):
+        if alive_at(b, i, j):
+            cx = int(positions[b, i, j].x * width)
+            cy = int(positions[b, i, j].y * height)
+            for dx, dy in ti.ndrange((-rad, rad + 1), (-rad, rad + 1)):
+                x = cx + dx
+                y = cy + dy
+                if dx * dx + dy * dy <= rad * rad and 0 <= x < width and 0 <= y < height:
+                    ti.atomic_max(export_ids[x, y], i * capacity + j + 1)
+    
+    for x, y in export_image:
+        color = ti.Vector([0.0, 0.0, 0.0])
+        
+        # Outlines of the two boxes if on valley map
+        if ti.static(hasValley):
+            u = x / width
+            v = y / height
+            inLeft = u <= boxWidth + 1 / width and v <= boxHeight + 1 / height
+            inRight = u >= 1 - boxWidth - 1 / width and v <= boxHeight + 1 / height
+            onEdge = ti.abs(u - boxWidth) <= 1 / width or ti.abs(u - (1 - boxWidth)) <= 1 / width or ti.abs(v - boxHeight) <= 1 / height or u <= 1 / width or u >= 1 - 1 / width or v <= 1 / height
+            if (inLeft or inRight) and onEdge:
+                color = ti.Vector([0.667, 0.667, 0.667])
+        
+        if export_ids[x, y] > 0:
+            color = render_colors[export_ids[x, y] - 1]
+        export_image[x, y] = ti.cast(color * 255, ti.u8)
+
+
+# Exporter writing frames as numbered images to a folder. Frames are drawn on the device and written
+# by a pool of threads. The queue is bounded, so the simulation only waits when the writers fall behind
+class Exporter:
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        setup_render_fields()
+        self.folder = folder
+        self.count = 0
+        
+        self.frames = queue.Queue(maxsize=2 * args.export_workers)
+        self.threads = [threading.Thread(target=self.write_frames, daemon=True) for _ in range(args.export_workers)]
+        for thread in self.threads:
+            thread.start()
+    
+    # Function for exporting the current frame of simulation b
+    def add(self, b, hasValley):
+        draw_frame(b, hasValley)
+        self.frames.put((self.count, export_image.to_numpy()))
+        self.count += 1
+    
+    # Function run by every writer thread
+    def write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            ti.tools.imwrite(frame[1], os.path.join(self.folder, f"{frame[0]:06d}.png"))
+    
+    # Function for writing the remaining frames (And encoding the video with --export-video)
+    def close(self):
+        for _ in self.threads:
+            self.frames.put(None)
+        for thread in self.threads:
+            thread.join()
+        print(f"Exported {self.count} frames to {self.folder}")
+        
+        if not args.export_video:
+            return
+        if shutil.which("ffmpeg") is None:
+            print("ffmpeg was not found, only the images are exported")
+            return
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-framerate", str(max(1, args.fps)),
+            "-i", os.path.join(self.folder, "%06d.png"),
+            "-c:v", "libx264", "-pix_fmt", "yuv420p", os.path.join(self.folder, "video.mp4")
+            ], check=True)
+
+
+# Function for exporting the regular simulation. Always exports '--export-frames' frames,
+# one every '--export-every' ticks, so runs can be compared frame by frame
+def export_simulation(amount, hasValley):
+    exporter = Exporter(args.export)
+    for frame in range(args.export_frames):
+        exporter.add(0, hasValley)
+        step_simulations(args.export_every, amount, hasValley)
+    exporter.close()
+
+
+# ================================================================
+#         Code for Optuna Optimization - Reward functions
+# ================================================================
+
+
+
+# Function to count eaten food particles and reward particle proximity to food in all simulations.
+# Results are written to 'eaten_result' and 'close_result'
+@ti.kernel
+def valley_rewards(maxPoints: float, particle_amount: int):
+    maxDist = ti.sqrt(2)        # Diagonal distance of GUI (Taichi GUI positions are defined from 0.0-1.0 in each dimension)
+    
+    for b in range(batch_size):
+        eaten_result[b] = 0
+        close_result[b] = 0.0
+    
+    # Loop through food particles and accumulate for dead ones
+    for b, j in ti.ndrange(batch_size, foodAmount):
+        if not alive_at(b, 1, j):
+            eaten_result[b] += 1
+    
+    # Loop through main particles
+    for b, j in ti.ndrange(batch_size, particle_amount):
+        
+        # Skip dead particles
+        if not alive_at(b, 0, j):
+            continue
+        
+        # Read particle position
+        particlePos = positions[b, 0, j]
+        
+        distSum = 0.0
+        
+        # Loop through food particles
+        for jj in range(foodAmount):
+            # Skip dead particles
+            if alive_at(b, 1, jj):
+                dir = positions[b, 1, jj] - particlePos     # Vector from current to food particle 
+                dist_sqr = dir.norm_sqr() + 1e-10       
+                distSum += ti.sqrt(dist_sqr)                # Accumulate distance
+        
+        # Compare average distance to food to max possible distance
+        # (When all food is eaten the particle gets full points)
+        aliveCnt = foodAmount - eaten_result[b]
+        scaledDist = 0.0
+        if aliveCnt > 0:
+            scaledDist = distSum / aliveCnt / maxDist
+        
+        # Add reward
+        close_result[b] += (1 - scaledDist) * maxPoints
+
+
+# Function to compute average nearby particles of the same species in all simulations. Particles are sorted
+# into a grid with cells at least 'range' wide, so only the 3x3 neighboring cells are searched.
+# Results are written to 'cluster_result'
+@ti.kernel
+def clustering_levels(range: float, particle_amount: int):
+    amount = loop_amount(particle_amount)
+    sort_into_cells_step(amount, reward_grid_res, reward_cell_count, reward_cell_offset, reward_cell_particles, False)
+    
+    for b in range(batch_size):
+        cluster_result[b] = 0.0
+    
+    # Loop through particles of all species
+    for b, i, j in ti.ndrange(batch_size, species, amount):
+        if not alive_at(b, i, j):
+            continue
+        
+        # Get particle position
+        pos1 = positions[b, i, j]
+        cx, cy = cell_of(pos1, reward_grid_res)
+        cnt = 0
+        
+        # Loop through the particles of the neighboring cells
+        for dx, dy in ti.ndrange((-1, 2), (-1, 2)):
+            ncx = cx + dx
+            ncy = cy + dy
+            if ncx < 0 or ncx >= reward_grid_res or ncy < 0 or ncy >= reward_grid_res:
+                continue
+            
+            c = ncx * reward_grid_res + ncy
+            for k in range(reward_cell_offset[b, c], reward_cell_offset[b, c] + reward_cell_count[b, c]):
+                pid = reward_cell_particles[b, k]
+                
+                # Only other particles of the same species count
+                if pid // capacity != i or pid % capacity == j:
+                    continue
+                
+                dir = positions[b, i, pid % capacity] - pos1     # Vector from current to other particle 
+                dist_sqr = dir.norm_sqr() + 1e-10
+                
+                # Accumulate count if withing range
+                if ti.sqrt(dist_sqr) < range:
+                    cnt += 1
+        
+        # Add count to sum
+        cluster_result[b] += cnt
+    
+    # Average particles within range
+    for b in range(batch_size):
+        if sim_amount[b] > 0:
+            cluster_result[b] /= sim_amount[b]
+
+
+# Function for the reward of every simulation on the valley map (One value per simulation)
+def rewards_forces_valley(particle_amount):
+    with timed("rewards"):
+        valley_rewards(1, particle_amount)
+        
+        # Add reward for amount of food particles eaten and for proximity to food for alive
+        # none-food-particles (Proximity is rounded down to whole points)
+        return eaten_result.to_numpy() * 100 + close_result.to_numpy().astype(int)
+
+
+# Function for the reward of every simulation on the box map (One value per simulation)
+def rewards_clusterization_box(particle_amount):
+    
+    # Reward for average number of particles within '5 * radius'
+    with timed("rewards"):
+        clustering_levels((5 * rad) / width, particle_amount)
+        return cluster_result.to_numpy()
+
+
+
+# ================================================================
+#         Code for Optuna Optimization - Studies and objective functions
+# ================================================================
+            
+
+
+# Function for the particles of an amount that are simulated at the current fidelity
+# (At least one, so a trial with particles never becomes empty)
+def fidelity_amount(amount):
+    if fidelity >= 1 or amount == 0:
+        return amount
+    return max(1, int(round(amount * fidelity)))
+
+
+# Function for applying Optuna suggestions for the valley map to simulation b
+def setup_forces_valley(trial, b, gravity, checkGround, layout_seed):
+    # Optuna suggests force values for main particle
+    force_00 = trial.suggest_float('force_00', 0.1, 1.0)
+    force_01 = trial.suggest_float('force_01', -1.0, 1.0)
+    amount = trial.suggest_int('Particles', 0, 200)
+    
+    # Reset the simulation to the initial state (Or the cached state after the fall to the ground).
+    # Below full fidelity only the first main particles of the same layout are simulated
+    keep = fidelity_amount(amount)
+    warm_start = args.warm_start and checkGround
+    if warm_start:
+        pos, vel, is_alive, sim_forces = settled_valley(amount, gravity, layout_seed)
+        if keep < amount:
+            pos, is_alive = pos.copy(), is_alive.copy()
+            pos[0, keep:amount] = [-1, 1]
+            is_alive[0, keep:amount] = 0
+        load_simulation(b, pos, vel, is_alive, sim_forces)
+        sim_amount[b] = keep
+        has_food[b] = True
+        set_trial_attr(trial, "warm_start", True)
+    else:
+        initValley(amount, b, layout_seed, keep)
+
+    # Apply suggestions to force field
+    forces[b, 0, 0] = force_00
+    forces[b, 0, 1] = force_01
+
+    # Set physics variables (Ticker of a warm started simulation runs from the first tick)
+    set_physics(b, gravity, glob_max_speed, glob_coll_force, checkGround)
+    if warm_start:
+        touched_ground[b] = True
+    
+    return keep
+
+
+# Function for running all simulations of the valley map for N steps / ticks
+def simulate_valley(steps, amount):
+    
+    # Without drawing all ticks are run without stopping
+    if drawing != 1:
+        step_simulations(steps, amount, hasValley=True)
+        return
+    
+    # Otherwise every 4th tick is drawn
+    for step in range(0, steps, 4):
+        step_simulations(min(4, steps - step), amount, hasValley=True)
+        if step + 4 <= steps:
+            render(True)
+
+
+# Function for removing the simulations of the batch that are not used
+def clear_unused(used):
+    for b in range(used, batch_size):
+        clear_simulation(b)
+
+
+# Function for the checkpoint file of a batch of trials (Named after the trials, so a rerun
+# of the same trials after a crash finds it)
+def checkpoint_path(objective_name, trial_batch, steps, layout_seeds):
+    keys = [None if trial is None else cache_key(objective_name, trial, steps, layout_seeds[b]) for b, trial in enumerate(trial_batch)]
+    name = hashlib.sha256(json.dumps(keys).encode()).hexdigest()[:16]
+    return os.path.join("checkpoints", name + ".npz")
+
+
+# Function for running the simulations of a batch of trials for N steps / ticks. With a pruner,
+# the reward of every trial is reported every 'report_every' ticks and pruned trials are stopped.
+# With checkpoints, the state is saved every 'checkpoint_every' ticks and a crashed run resumes from it.
+# 'rewards' gives the reward of all simulations, and simulations without a trial (None) are skipped.
+# 'layout_seeds' is the seed of each simulation. Seeds of an ensemble all belong to the same trial,
+# so they are never pruned. Returns which trials were pruned
+def simulate_trials(objective_name, trial_batch, steps, amount, hasValley, rewards, layout_seeds):
+    pruned_at = [0] * len(trial_batch)          # Tick where each trial was pruned (0 = not pruned)
+    running = [b for b, trial in enumerate(trial_batch) if trial is not None]
+    step = 0
+    
+    # Ticks where the simulation stops for reports, checkpoints and recorded frames
+    intervals = []
+    pruning = args.pruner != "none" and not ensemble_seeds and fidelity_rungs == 1
+    if pruning:
+        intervals.append(args.report_every)
+    
+    # Finished simulations are found on the device and checked by the host every 'monitor_every' ticks
+    if early_stop:
+        intervals.append(monitor_every)
+    
+    path = None
+    if args.checkpoint_every > 0:
+        intervals.append(args.checkpoint_every)
+        path = checkpoint_path(objective_name, trial_batch, steps, layout_seeds)
+        
+        # Resume from the checkpoint of a crashed run of the same trials
+        if os.path.exists(path):
+            arrays = load_snapshot(path)
+            step = int(arrays["step"])
+            pruned_at = [int(tick) for tick in arrays["pruned_at"]]
+            running = [b for b in running if pruned_at[b] == 0]
+            for b, trial in enumerate(trial_batch):
+                if trial is not None:
+                    set_trial_attr(trial, "resumed_from", step)
+    
+    # Every trial is recorded to its own file
+    recorders = {}
+    if args.record_trials:
+        intervals.append(args.record_every)
+        for b in running:
+            name = f"{objective_name}_{trial_batch[b].number}"
+            if ensemble_seeds:
+                name += f"_seed{layout_seeds[b]}"
+            recording = os.path.join("recordings", name + ".plrec")
+            recorders[b] = Recorder(recording, "valley" if hasValley else "box", step)
+            recorders[b].record(b, step)
+            set_trial_attr(trial_batch[b], "recording", recording)
+    
+    while step < steps and len(running) > 0:
+        stop = steps
+        for interval in intervals:
+            stop = min(stop, (step // interval + 1) * interval)
+        if hasValley:
+            simulate_valley(stop - step, amount)
+        else:
+            simulate_box(stop - step, amount)
+        step = stop
+        
+        if args.record_trials and step % args.record_every == 0:
+            with timed("record"):
+                for b in running:
+                    recorders[b].record(b, step)
+        
+        # Report partial rewards and stop the pruned trials (The last report is never pruned)
+        if pruning and (step % args.report_every == 0 or step == steps):
+            values = rewards(amount)
+            with timed("storage"):
+                for b in list(running):
+                    trial_batch[b].report(float(values[b]), step)
+                    if step < steps and trial_batch[b].should_prune():
+                        pruned_at[b] = step
+                        running.remove(b)
+                        clear_simulation(b)
+        
+        # Finished trials need no more ticks, since their reward can not change anymore
+        if early_stop and step % monitor_every == 0:
+            done = finished.to_numpy()
+            for b in list(running):
+                if done[b]:
+                    running.remove(b)
+        
+        if path is not None and step % args.checkpoint_every == 0 and step < steps:
+            with timed("checkpoint"):
+                os.makedirs("checkpoints", exist_ok=True)
+                save_snapshot(path, {"step": np.array(step), "pruned_at": np.array(pruned_at)})
+    
+    for recorder in recorders.values():
+        recorder.close()
+    
+    # The checkpoint is not needed when all ticks are done
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+    
+    # Steps of the adaptive integrator needed for the simulated ticks, and the ticks where simulations finished
+    steps_taken = integrator_steps.to_numpy() if adaptive else None
+    done = finished.to_numpy()
+    done_at = finished_at.to_numpy()
+    reasons = finish_reason.to_numpy()
+    
+    for b, trial in enumerate(trial_batch):
+        if trial is not None:
+            ticks = steps
+            if pruned_at[b] > 0:
+                ticks = pruned_at[b]
+            elif early_stop and done[b]:
+                ticks = int(done_at[b])
+            set_trial_attr(trial, "ticks_simulated", ticks)
+            
+            # The reason is written for every simulation, so the reason of an earlier rung never remains
+            if early_stop:
+                set_trial_attr(trial, "finish_reason", finish_reasons[reasons[b]] if done[b] and pruned_at[b] == 0 else "")
+            if adaptive:
+                set_trial_attr(trial, "integrator_steps", int(steps_taken[b]))
+    
+    return [tick > 0 for tick in pruned_at]
+
+
+# Version of the simulation code (Cached results of other versions are never used)
+code_version = hashlib.sha256(open(__file__, "rb").read()).hexdigest()[:16]
+
+
+# Function for opening the objective result cache
+def open_cache():
+    connection = sqlite3.connect("objective_cache.sqlite3", timeout=300)
+    connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value REAL)")
+    return connection
+
+
+# Function for the cache key of a trial (Everything the result depends on)
+def cache_key(objective_name, trial, steps, layout_seed):
+    key = {
+        "objective": objective_name,
+        "params": trial.params,
+        "seed": layout_seed,
+        "steps": steps,
+        "version": code_version,
+        "engine": engine,
+        "cutoff": interaction_cutoff if engine == "grid" else None,
+        "bh_theta": bh_theta if engine == "barnes_hut" else None,
+        "precision": args.precision,
+        "deterministic": deterministic,
+        "warm_start": args.warm_start,
+        "species": species,
+        "early_stop": [steady_window, steady_energy] if early_stop else False,
+        "integrator": [cfl, dt_max] if adaptive else "fixed",
+        "state_precision": "f64" if state_float == ti.f64 else "f32",
+        "type_capacity": per_type_capacity
+        }
+    
+    # Fraction of the particles simulated (Not part of the key at full fidelity, so those results are shared)
+    if fidelity < 1:
+        key["fidelity"] = fidelity
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Function for the cached result of a trial. Returns None when the trial has not been simulated
+# (Only used with --cache and a seed, since results of random layouts can not be reused)
+def cache_lookup(objective_name, trial, steps, layout_seed):
+    if not args.cache or layout_seed is None:
+        return None
+    
+    connection = open_cache()
+    row = connection.execute("SELECT value FROM results WHERE key = ?", (cache_key(objective_name, trial, steps, layout_seed),)).fetchone()
+    connection.close()
+    
+    if row is None:
+        return None
+    set_trial_attr(trial, "cached", True)
+    set_trial_attr(trial, "ticks_simulated", 0)
+    if early_stop:
+        set_trial_attr(trial, "finish_reason", "")
+    return row[0]
+
+
+# Function for saving the result of a trial in the cache
+def cache_store(objective_name, trial, steps, layout_seed, value):
+    if not args.cache or layout_seed is None:
+        return
+    
+    connection = open_cache()
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", (cache_key(objective_name, trial, steps, layout_seed), value))
+    connection.close()
+
+
+# Settled valley states of every particle amount and gravity (Loaded from disk or simulated once)
+settled_states = {}
+
+
+# Function for the state of the valley map when the first particle has fallen to the ground.
+# Returns the arrays for 'load_simulation'. Simulated once with the default forces and saved in
+# the folder 'settled', so later trials and runs skip the fall
+def settled_valley(amount, gravity, layout_seed):
+    if layout_seed is None:
+        layout_seed = 0
+    key = (amount, gravity, layout_seed)
+    if key in settled_states:
+        return settled_states[key]
+    
+    path = os.path.join("settled", f"valley_{amount}_{gravity}_{layout_seed}_{code_version}.npz")
+    if os.path.exists(path):
+        with np.load(path) as data:
+            state = (data["positions"], data["velocities"], data["alive"], data["forces"])
+    else:
+        # Simulated in the first simulation of the batch (All other simulations are restored after)
+        saved = snapshot()
+        for b in range(batch_size):
+            clear_simulation(b)
+        initValley(amount, 0, layout_seed)
+        set_physics(0, gravity, glob_max_speed, glob_coll_force)
+        
+        ticks = 0
+        while amount > 0 and not touched_ground[0] and ticks < 10000:
+            step_simulations(1, amount, hasValley=True)
+            ticks += 1
+        
+        state = (positions.to_numpy()[0], velocities.to_numpy()[0], alive_to_numpy()[0].astype(np.int32), forces.to_numpy()[0])
+        restore(saved)
+        
+        os.makedirs("settled", exist_ok=True)
+        np.savez(path, positions=state[0], velocities=state[1], alive=state[2], forces=state[3])
+    
+    settled_states[key] = state
+    return state
+
+
+# Function for evaluating a batch of trials (One trial per simulation in the batch, started from the
+# layout of its seed in 'layout_seeds'). 'setup' applies the suggestions of a trial to a simulation
+# and returns its particle amount. Cached trials are not simulated, and pruned trials have the value None
+def evaluate_trials(objective_name, trial_batch, setup, steps, hasValley, rewards, layout_seeds):
+    with timed("setup"):
+        amounts = [setup(trial, b, layout_seeds[b]) for b, trial in enumerate(trial_batch)]
+        clear_unused(len(trial_batch))
+    
+    # Simulations of cached trials are removed
+    with timed("cache"):
+        values = [cache_lookup(objective_name, trial, steps, layout_seeds[b]) for b, trial in enumerate(trial_batch)]
+    simulated = [None if values[b] is not None else trial for b, trial in enumerate(trial_batch)]
+    for b in range(len(trial_batch)):
+        if simulated[b] is None:
+            clear_simulation(b)
+    
+    if any(trial is not None for trial in simulated):
+        # Run all simulations for N steps / ticks
+        pruned = simulate_trials(objective_name, simulated, steps, max(amounts), hasValley, rewards, layout_seeds)
+        
+        # Compute and cache rewards of the finished trials
+        rewards_end = rewards(max(amounts))
+        for b, trial in enumerate(simulated):
+            if trial is not None and not pruned[b]:
+                values[b] = float(rewards_end[b])
+                cache_store(objective_name, trial, steps, layout_seeds[b], values[b])
+    
+    return values
+
+
+# Function for scoring a trial on the seeds of the ensemble. Seeds are simulated in rounds of
+# 'ensemble_round' together, and no more rounds are run when the standard error of the mean is
+# below 'ensemble_se'. The value is the mean, and the statistics are stored on the trial
+def evaluate_ensemble(objective_name, trial, setup, steps, hasValley, rewards):
+    scores = []
+    for start in range(0, len(ensemble_seeds), batch_size):
+        round_seeds = ensemble_seeds[start:start + batch_size]
+        scores += evaluate_trials(objective_name, [trial] * len(round_seeds), setup, steps, hasValley, rewards, round_seeds)
+        
+        if len(scores) >= 2 and np.std(scores, ddof=1) / np.sqrt(len(scores)) < args.ensemble_se:
+            break
+    
+    mean = float(np.mean(scores))
+    variance = float(np.var(scores, ddof=1)) if len(scores) >= 2 else 0.0
+    set_trial_attr(trial, "ensemble_seeds", ensemble_seeds[:len(scores)])
+    set_trial_attr(trial, "ensemble_values", scores)
+    set_trial_attr(trial, "ensemble_mean", mean)
+    set_trial_attr(trial, "ensemble_variance", variance)
+    set_trial_attr(trial, "ensemble_se", float(np.sqrt(variance / len(scores))))
+    return mean
+
+
+# Function for evaluating a batch of trials at the current fidelity. Every trial is either one
+# simulation from the layout of its seed in 'layout_seeds', or an ensemble of seeds
+def evaluate_fidelity(objective_name, trial_batch, setup, steps, hasValley, rewards, layout_seeds):
+    if ensemble_seeds:
+        return [evaluate_ensemble(objective_name, trial, setup, steps, hasValley, rewards) for trial in trial_batch]
+    return evaluate_trials(objective_name, trial_batch, setup, steps, hasValley, rewards, layout_seeds)
+
+
+# Function for whether a trial is promoted to the next rung of successive halving. The trial is compared
+# with all trials of the study scored in the same rung (Asynchronously, so the first trials are promoted)
+# and is promoted when it is in the best 1 / eta of them
+def promoted(trial, rung, value):
+    others = []
+    for other in trial.study.get_trials(deepcopy=False):
+        other_values = other.user_attrs.get("fidelity_values", [])
+        if other.number != trial.number and len(other_values) > rung:
+            others.append(other_values[rung])
+    
+    better = sum(other > value for other in others)
+    return better < max(1, (len(others) + 1) // fidelity_eta)
+
+
+# Function for the ticks of every rung of successive halving, and the fidelity of the rung
+def fidelity_levels(steps):
+    levels = []
+    for rung in range(fidelity_rungs):
+        rung_fidelity = float(fidelity_eta) ** (rung - fidelity_rungs + 1)
+        levels.append((max(1, int(round(steps * rung_fidelity))), rung_fidelity))
+    return levels
+
+
+# Function for evaluating a batch of trials with the objective. With multi-fidelity, all trials are
+# scored with a fraction of the ticks and particles first, and only promoted trials are simulated at
+# the next rung. Trials that are not promoted are pruned with their last value as intermediate value,
+# so only values at full fidelity are ever the value of a trial
+def evaluate(objective_name, trial_batch, setup, steps, hasValley, rewards):
+    global fidelity
+    started = time.perf_counter()
+    reset_profile()
+    start_heartbeat(trial_batch)
+    
+    # Layout of every trial. Without a seed, multi-fidelity trials draw their own seed, so every rung
+    # starts from the same layout
+    layout_seeds = [seed] * len(trial_batch)
+    if not ensemble_seeds:
+        for b, trial in enumerate(trial_batch):
+            if seed is None and fidelity_rungs > 1:
+                layout_seeds[b] = random.randrange(2 ** 31)
+            if layout_seeds[b] is not None:
+                set_trial_attr(trial, "seed", layout_seeds[b])
+    
+    values = [None] * len(trial_batch)
+    running = list(range(len(trial_batch)))
+    levels = {b: [] for b in running}
+    rung_values = {b: [] for b in running}
+    rung_ticks = {b: [] for b in running}
+    rung_reasons = {b: [] for b in running}
+    for rung, (rung_steps, fidelity) in enumerate(fidelity_levels(steps)):
+        scores = evaluate_fidelity(objective_name, [trial_batch[b] for b in running], setup, rung_steps, hasValley, rewards, [layout_seeds[b] for b in running])
+        for b, score in zip(running, scores):
+            levels[b].append([rung_steps, fidelity])
+            rung_values[b].append(score)
+            if fidelity_rungs > 1:
+                # Ticks simulated and finish reason of every rung (The attributes only hold the last rung)
+                rung_ticks[b].append(trial_batch[b].user_attrs.get("ticks_simulated", rung_steps))
+                set_trial_attr(trial_batch[b], "fidelity_levels", levels[b])
+                set_trial_attr(trial_batch[b], "fidelity_values", rung_values[b])
+                set_trial_attr(trial_batch[b], "fidelity_ticks", rung_ticks[b])
+                set_trial_attr(trial_batch[b], "fidelity", fidelity)
+                if early_stop:
+                    rung_reasons[b].append(trial_batch[b].user_attrs.get("finish_reason", ""))
+                    set_trial_attr(trial_batch[b], "fidelity_reasons", rung_reasons[b])
+        
+        if rung == fidelity_rungs - 1:
+            for b, score in zip(running, scores):
+                values[b] = score
+            break
+        
+        # Trials that are not promoted report their score for the sampler
+        promote = []
+        for b, score in zip(running, scores):
+            if promoted(trial_batch[b], rung, score):
+                promote.append(b)
+            else:
+                with timed("storage"):
+                    trial_batch[b].report(float(score), rung_steps)
+        running = promote
+        if len(running) == 0:
+            break
+    fidelity = 1.0
+    stop_heartbeat(trial_batch)
+    
+    store_profile(objective_name, trial_batch, started)
+    return values
+
+
+# Function for the value of a single trial (Raises the Optuna exception for pruned trials)
+def trial_value(value):
+    if value is None:
+        raise optuna.TrialPruned()
+    return value
+
+
+# Batched objective function for training on valley map (One trial per simulation in the batch)
+def objective_forces_valley_batch(trial_batch, gravity=glob_gravity, checkGround=True):
+    objective_name = "valley" if checkGround else "valley_zeroG"
+    setup = lambda trial, b, layout_seed: setup_forces_valley(trial, b, gravity, checkGround, layout_seed)
+    return evaluate(objective_name, trial_batch, setup, 4000, True, rewards_forces_valley)
+
+
+# Batched objective function for training on valley map without gravity
+# (Not necessary to check for ground contact)
+def objective_forces_valley_zeroG_batch(trial_batch):
+    return objective_forces_valley_batch(trial_batch, gravity=0, checkGround=False)
+
+
+# Objective function for training on valley map
+def objective_forces_valley(trial):
+    return trial_value(objective_forces_valley_batch([trial])[0])
+
+
+# Objective function for training on valley map without gravity
+def objective_forces_valley_zeroG(trial):
+    return trial_value(objective_forces_valley_zeroG_batch([trial])[0])
+
+
+# Function for applying Optuna suggestions for the box map to simulation b
+def setup_clusterization_box(trial, b, layout_seed):
+    # Optuna suggests physics variable values
+    gravity = trial.suggest_float('gravity', 0.0, 0.2)
+    coll_force = trial.suggest_int('coll_force', 0, 1000)
+    max_speed = trial.suggest_float('max_speed', 0.0001, 0.08)
+    
+    # Ammount of particles (Fewer of the same layout below full fidelity)
+    amount = 500
+    keep = fidelity_amount(amount)
+    
+    # Reset the simulation to the initial state
+    initBox(amount, b, layout_seed, keep)
+    set_physics(b, gravity, max_speed, coll_force)
+    
+    return keep
+
+
+# Function for running all simulations of the box map for N steps / ticks
+def simulate_box(steps, amount):
+    
+    # Without drawing all ticks are run without stopping
+    if drawing != 1:
+        step_simulations(steps, amount, hasValley=False)
+        return
+    
+    # Otherwise every 3rd tick is drawn
+    for step in range(0, steps, 3):
+        step_simulations(min(3, steps - step), amount, hasValley=False)
+        if step + 3 <= steps:
+            render(False)
+
+
+# Batched objective function for training on box map (One trial per simulation in the batch)
+# Reward is the average number of particles within '5 * radius'
+def objective_clusterization_box_batch(trial_batch):
+    return evaluate("box", trial_batch, setup_clusterization_box, 2000, False, rewards_clusterization_box)
+
+
+# Objective function for training on box map
+def objective_clusterization_box(trial):
+    return trial_value(objective_clusterization_box_batch([trial])[0])
+
+
+# Function for optimizing a study. With a batch size above 1, trials are asked from Optuna
+# in groups and all simulations of a group are run together.
+# Parallel workers give 'total' instead of 'trials' and stop when the study has that many trials.
+# When profiling, trials are always asked and told here, so the time of 'tell' is measured too
+def optimize(study, objective, objective_batch, trials=None, total=None):
+    if trial_batch_size == 1 and not profiling:
+        callbacks = []
+        if total is not None:
+            callbacks.append(optuna.study.MaxTrialsCallback(total, states=None))
+        study.optimize(objective, n_trials=trials, callbacks=callbacks)
+        return
+    
+    done = 0
+    while True:
+        # Number of trials still missing
+        if total is None:
+            remaining = trials - done
+        else:
+            remaining = total - len(study.get_trials(deepcopy=False))
+        if remaining <= 0:
+            break
+        
+        trial_batch = [study.ask() for _ in range(min(trial_batch_size, remaining))]
+        values = objective_batch(trial_batch)
+        start = time.perf_counter()
+        for trial, value in zip(trial_batch, values):
+            if value is None:
+                study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+            else:
+                study.tell(trial, value)
+        done += len(trial_batch)
+        
+        if profiling:
+            store_tell_time(study, trial_batch, time.perf_counter() - start)
+
+
+# Function for the pruner chosen on the command line
+def get_pruner():
+    if args.pruner == "median":
+        return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=args.report_every)
+    if args.pruner == "hyperband":
+        return optuna.pruners.HyperbandPruner(min_resource=args.report_every, max_resource="auto")
+    return optuna.pruners.NopPruner()
+
+
+# Function for the rungs a trial was simulated at: the ticks scheduled, the ticks simulated and the finish
+# reason of every rung (One rung of 'steps' ticks without multi-fidelity)
+def trial_rungs(trial, steps):
+    attrs = trial.user_attrs
+    if "fidelity_levels" in attrs:
+        scheduled = [level[0] for level in attrs["fidelity_levels"]]
+        simulated = attrs.get("fidelity_ticks", scheduled)
+        reasons = attrs.get("fidelity_reasons", [""] * len(scheduled))
+    else:
+        scheduled = [steps]
+        simulated = [attrs.get("ticks_simulated", steps)]
+        reasons = [attrs.get("finish_reason", "")]
+    return list(zip(scheduled, simulated, reasons))
+
+
+# Function for recording how much simulation the pruner saved in a study. Ticks are compared with the
+# ticks scheduled for the rungs the trials were simulated at. Stored as study attributes and printed
+def record_pruning_stats(study, steps):
+    rungs = {trial.number: trial_rungs(trial, steps) for trial in study.get_trials(deepcopy=False)}
+    ticks_total = sum(scheduled for trial_rungs in rungs.values() for scheduled, _, _ in trial_rungs)
+    study.set_user_attr("ticks_scheduled", ticks_total)
+    
+    # Rungs stopped by the pruner (Cached rungs simulated no ticks and are not counted)
+    trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.PRUNED])
+    ticks_saved = sum(scheduled - simulated for trial in trials for scheduled, simulated, reason in rungs[trial.number] if 0 < simulated < scheduled and not reason)
+    
+    study.set_user_attr("pruned_trials", len(trials))
+    study.set_user_attr("ticks_saved_by_pruning", ticks_saved)
+    
+    if ticks_total > 0:
+        print(f"{study.study_name}: {len(trials)} trials pruned, {ticks_saved} of {ticks_total} ticks saved ({100 * ticks_saved / ticks_total:.1f}%)")
+    
+    # Rungs that finished early (--early-stop)
+    if early_stop:
+        finished_rungs = {number: [(scheduled, simulated) for scheduled, simulated, reason in trial_rungs if reason] for number, trial_rungs in rungs.items()}
+        ticks_saved = sum(scheduled - simulated for trial_rungs in finished_rungs.values() for scheduled, simulated in trial_rungs)
+        study.set_user_attr("ticks_saved_by_early_stop", ticks_saved)
+        if ticks_total > 0:
+            print(f"{study.study_name}: {sum(1 for trial_rungs in finished_rungs.values() if trial_rungs)} trials finished early, {ticks_saved} of {ticks_total} ticks saved ({100 * ticks_saved / ticks_total:.1f}%)")
+    
+    # Rungs of successive halving that trials were not promoted to (Not part of the scheduled ticks)
+    if fidelity_rungs > 1:
+        levels = fidelity_levels(steps)
+        stopped_trials = [trial_rungs for trial_rungs in rungs.values() if 0 < len(trial_rungs) < len(levels)]
+        ticks_saved = sum(ticks for trial_rungs in stopped_trials for ticks, _ in levels[len(trial_rungs):])
+        study.set_user_attr("ticks_saved_by_fidelity", ticks_saved)
+        print(f"{study.study_name}: {len(stopped_trials)} trials stopped at a lower fidelity, {ticks_saved} ticks of higher rungs not simulated")
+
+
+# Function for the sampler of a study. With a seed the suggested parameters are reproducible
+# (Each worker gets its own seed, so the workers do not suggest the same parameters)
+def get_sampler(worker_index=0):
+    if seed is None:
+        return None
+    return optuna.samplers.TPESampler(seed=seed + worker_index)
+
+
+# Function for the study storage. SQLite waits for locks held by other workers and retries trials
+# of crashed workers (Found by their heartbeat). The journal file is safe for many writers, but Optuna
+# keeps no heartbeat for it, so its trials get an owner and heartbeat as trial attributes, and crashed
+# trials are retried by 'retry_crashed_trials' when training starts
+def get_storage():
+    if args.storage == "journal":
+        return optuna.storages.JournalStorage(optuna.storages.journal.JournalFileBackend("db.journal"))
+    
+    return optuna.storages.RDBStorage(
+        "sqlite:///db.sqlite3",
+        engine_kwargs={"connect_args": {"timeout": 300}},
+        heartbeat_interval=heartbeat_interval,
+        heartbeat_stale_trial_callback=optuna.storages.RetryHeartbeatStaleTrialCallback(max_retry=max_retry)
+        )
+
+
+# Times a crashed trial is retried
+max_retry = 3
+
+# Seconds between the heartbeats of running trials. A trial without a heartbeat for two intervals is crashed
+heartbeat_interval = 60
+
+# Trials of the journal storage being evaluated by this process, and the thread writing their heartbeats
+beating_trials = set()
+beating_lock = threading.Lock()
+heartbeat_thread = None
+
+
+# Function for the owner of the trials evaluated by this process
+def trial_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Function for writing the heartbeat of the evaluated trials every 'heartbeat_interval' seconds (Background thread).
+# Trials that can not be written anymore (Finished or failed) are removed
+def write_heartbeats():
+    while True:
+        time.sleep(heartbeat_interval)
+        with beating_lock:
+            trials = list(beating_trials)
+        for trial in trials:
+            try:
+                trial.set_user_attr("heartbeat", time.time())
+            except Exception:
+                with beating_lock:
+                    beating_trials.discard(trial)
+
+
+# Function for marking trials of the journal storage with their owner and starting their heartbeat
+def start_heartbeat(trial_batch):
+    global heartbeat_thread
+    if args.storage != "journal":
+        return
+    
+    trials = [trial for trial in trial_batch if isinstance(trial, optuna.trial.Trial)]
+    for trial in trials:
+        set_trial_attr(trial, "owner", trial_owner())
+        set_trial_attr(trial, "heartbeat", time.time())
+    with beating_lock:
+        beating_trials.update(trials)
+    
+    if heartbeat_thread is None:
+        heartbeat_thread = threading.Thread(target=write_heartbeats, daemon=True)
+        heartbeat_thread.start()
+
+
+# Function for stopping the heartbeat of evaluated trials
+def stop_heartbeat(trial_batch):
+    with beating_lock:
+        beating_trials.difference_update(trial_batch)
+
+
+# Function for whether the process owning a trial has ended. Only known for processes on this host
+# (And not on Windows, where signals can not check a process), otherwise only the heartbeat tells
+def owner_gone(owner):
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid() or os.name == "nt":
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+# Function for retrying the trials of crashed runs in the journal storage. A running trial has crashed when
+# the process owning it has ended or its heartbeat is older than two intervals (Trials without a heartbeat
+# yet use their start time), so the trials of other runs using the same journal keep running. Crashed
+# trials are failed and enqueued again with the same parameters. The new trial then resumes from the
+# checkpoint of the crashed trial (With --checkpoint-every)
+def retry_crashed_trials(study):
+    if args.storage != "journal":
+        return
+    
+    for trial in study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.RUNNING]):
+        heartbeat = trial.user_attrs.get("heartbeat")
+        if heartbeat is None and trial.datetime_start is not None:
+            heartbeat = trial.datetime_start.timestamp()
+        stale = heartbeat is None or time.time() - heartbeat > 2 * heartbeat_interval
+        if not stale and not owner_gone(trial.user_attrs.get("owner")):
+            continue
+        
+        # The trial may have finished since it was read
+        try:
+            study.tell(trial.number, state=optuna.trial.TrialState.FAIL)
+        except ValueError:
+            continue
+        
+        retries = trial.user_attrs.get("retries", 0)
+        if retries < max_retry:
+            study.enqueue_trial(trial.params, user_attrs={"retries": retries + 1, "retried_from": trial.number})
+
+
+# Function run by each worker process. A worker starts on its own study and helps
+# with the other studies when its own has enough trials
+def optimize_worker(jobs, worker_index):
+    for k in range(len(jobs)):
+        study_name, objective, objective_batch, total = jobs[(worker_index + k) % len(jobs)]
+        study = optuna.load_study(study_name=study_name, storage=get_storage(), pruner=get_pruner(), sampler=get_sampler(worker_index))
+        optimize(study, objective, objective_batch, total=total)
+
+
+# Function for running studies. Each job is (study name, objective, batched objective, number of trials).
+# With more than one worker, all studies run at the same time in separate processes
+def run_studies(jobs):
+    studies = {}
+    for study_name, objective, objective_batch, n_trials in jobs:
+        studies[study_name] = optuna.create_study(
+            direction='maximize', 
+            storage=get_storage(), 
+            study_name=study_name, 
+            pruner=get_pruner(),
+            sampler=get_sampler(),
+            load_if_exists=True
+            )
+        retry_crashed_trials(studies[study_name])
+    
+    # Serial optimization of one study after the other
+    if args.workers <= 1:
+        for study_name, objective, objective_batch, n_trials in jobs:
+            optimize(studies[study_name], objective, objective_batch, n_trials)
+        return studies
+    
+    # Workers stop when a study has its old trials plus the new ones
+    worker_jobs = []
+    for study_name, objective, objective_batch, n_trials in jobs:
+        total = len(studies[study_name].get_trials(deepcopy=False)) + n_trials
+        worker_jobs.append((study_name, objective, objective_batch, total))
+    
+    # Split the CPU cores between the workers (Each worker has its own Taichi runtime)
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    share = max(1, len(cpus) // args.workers)
+    
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for w in range(args.workers):
+        worker_cpus = [cpus[(w * share + k) % len(cpus)] for k in range(share)]
+        os.environ["PARTICLE_LIFE_WORKER_CPUS"] = ",".join(str(cpu) for cpu in worker_cpus)
+        process = context.Process(target=optimize_worker, args=(worker_jobs, w))
+        process.start()
+        processes.append(process)
+    del os.environ["PARTICLE_LIFE_WORKER_CPUS"]
+    
+    for process in processes:
+        process.join()
+    
+    return studies
+
+
+# Training function for valley map
+def train_forces_valley(trials):
+    # Create and optimize study and study for zero gravity simulation (At the same time with several workers)
+    studies = run_studies([
+        ("Valley", objective_forces_valley, objective_forces_valley_batch, trials),
+        ("Valley_ZeroG", objective_forces_valley_zeroG, objective_forces_valley_zeroG_batch, 100)
+        ])
+    study = studies["Valley"]
+    study2 = studies["Valley_ZeroG"]
+    record_pruning_stats(study, 4000)
+    record_pruning_stats(study2, 4000)
+
+    # Print best result and parameter values:
+    print("Best trial:")
+    trial = study.best_trial
+
+    print(f" Value: {trial.value}")
+    print("  Params: ")
+    for key, value in trial.params.items():
+        print(f"    {key}: {value}")
+    
+    # Draw visualizations
+    if not headless:
+        optuna.visualization.plot_parallel_coordinate(study, params=['force_00', 'force_01', 'Particles']).show()
+    
+    # Draw visualizations
+    if not headless:
+        optuna.visualization.plot_parallel_coordinate(study2, params=['force_00', 'force_01', 'Particles']).show()
+    
+    
+  
+# Training function for box map    
+def train_clusterization_box(trials):
+    # Create and optimize study with objective function
+    studies = run_studies([
+        ("Clusterization", objective_clusterization_box, objective_clusterization_box_batch, trials)
+        ])
+    study = studies["Clusterization"]
+    record_pruning_stats(study, 2000)
+
+    # Print best result and parameter values:
+    print("Best trial:")
+    trial = study.best_trial
+    print(f" Value: {trial.value}")
+    print("  Params: ")
+    for key, value in trial.params.items():
+        print(f"    {key}: {value}")
+    
+    # Draw visualizations
+    if not headless:
+        optuna.visualization.plot_slice(study, params=['gravity', 'coll_force', 'max_speed']).show()
+        optuna.visualization.plot_param_importances(study, params=['gravity', 'coll_force', 'max_speed']).show()
+
+
+# ================================================================
+#         Differentiable simulation (Gradient ascent instead of Optuna)
+# ================================================================
 
 
-# Run function for valley map
-def run_valley():
+# The differentiable simulation replaces the hard branches of the simulation with smooth surrogates,
+# so Taichi autodiff gives the gradient of the reward with respect to the forces and physics:
+#   - particles are never removed, but have an alive weight that fades out at the valley bottom (Food fades out when eaten)
+#   - repulsion fades in at the collision range, and main particles stop feeling food within eat range
+#   - the speed limit is a smooth limit instead of clamping, and there is no bounce
+# Only one segment of 'segment' ticks is kept in memory (Checkpointing). The gradient of an earlier segment
+# is computed by simulating it again from its first tick, with the gradient of its last tick as reward.
+# The gradient only goes through the last 'horizon' ticks: particles push each other at max speed, so
+# the gradient through more ticks grows about exponentially (Beyond about 20 box ticks it is far larger
+# than the slope the finite differences see, often with the other sign). Earlier ticks are only simulated
+# forward, and the state at the start of the horizon counts as fixed
+diff_smoothing = args.grad_smooth * rad / width          # Width of the smooth surrogates
+diff_eat_rate = 5.0                                       # Food alive weight falls by exp(-rate) per main particle in eat range
+diff_physics_names = ["gravity", "max_speed", "coll_force"]
+
+
+# Function for allocating the fields of the differentiable simulation for P particles (All types in one list)
+def allocate_diff_fields(particles, segment):
+    global diff_pos, diff_vel, diff_alive, diff_type, diff_acc, diff_eat, diff_food_dist, diff_food_weight
+    global diff_forces, diff_physics, diff_reward, diff_contact
+    global diff_pos_adj, diff_vel_adj, diff_alive_adj
     
-    # Get physics variables
-    amount = 100
-    gravity = glob_gravity
-    max_speed = glob_max_speed
-    coll_force = glob_coll_force
+    # State of each tick of the segment
+    diff_pos = ti.Vector.field(2, dtype=float, shape=(segment + 1, particles), needs_grad=True)
+    diff_vel = ti.Vector.field(2, dtype=float, shape=(segment + 1, particles), needs_grad=True)
+    diff_alive = ti.field(float, shape=(segment + 1, particles), needs_grad=True)
+    diff_type = ti.field(int, shape=particles)
+    diff_acc = ti.Vector.field(2, dtype=float, shape=(segment, particles), needs_grad=True)     # Sum of the forces of all pairs
+    diff_eat = ti.field(float, shape=(segment, particles), needs_grad=True)                    # Main particles within eat range of food
+    diff_food_dist = ti.field(float, shape=particles, needs_grad=True)                         # Sum of the distances to the alive food
+    diff_food_weight = ti.field(float, shape=particles, needs_grad=True)                       # Sum of the alive weights of the food
     
-    # Initialize
-    initValley(amount)
+    # Parameters (Forces between types, and gravity, max speed and collision force)
+    diff_forces = ti.field(float, shape=(types, types), needs_grad=True)
+    diff_physics = ti.field(float, shape=3, needs_grad=True)
     
-    # Values for loop (Ticker starts after a particle touches ground)
-    hasTouchedGround = False
-    tickCount = 0
+    # Reward (Or gradient of the next segment times the last tick), and tick of the first ground contact (-1 = none)
+    diff_reward = ti.field(float, shape=(), needs_grad=True)
+    diff_contact = ti.field(int, shape=())
     
-    # Main execution loop
-    while gui.running:
-        # Check for ground contact
-        if not hasTouchedGround:
-            hasTouchedGround = checkTouchGround(amount)
-        # Start counter after contact
-        else:
-            tickCount += 1
-        
-        # Update velocities
-        update_vel(tickCount, max_speed, coll_force, gravity, amount)
-        
-        # Move all particles
-        move_valley(amount)
-        
-        # Draw all particles and map
-        render(hasValley=True)
+    # Gradient of the reward with respect to the first tick of the next segment
+    diff_pos_adj = ti.Vector.field(2, dtype=float, shape=particles)
+    diff_vel_adj = ti.Vector.field(2, dtype=float, shape=particles)
+    diff_alive_adj = ti.field(float, shape=particles)
 
-# Run function for box map
-def run_box():
-    
-    # Get physics variables
-    amount = glob_amount
-    gravity = glob_gravity
-    max_speed = glob_max_speed
-    coll_force = glob_coll_force
-    
-    # Initialize
-    initBox(amount)
-    
-    # Main execution loop
-    while gui.running:
+
+# Function for a smooth step from 0 to 1 around x = 0 (Used inside kernels, clamped so exp never overflows)
+@ti.func
+def smooth_step(x):
+    return 1 / (1 + ti.exp(-max(-30.0, min(30.0, x))))
+
+
+# Function for the forces of all pairs of particles in tick t of the segment (Global tick 'tick') with smooth surrogates.
+# Pairs are added to the fields instead of local sums, since autodiff of local sums over a loop needs a stack per particle
+@ti.kernel
+def diff_pair_forces(t: int, tick: int, particles: int, hasValley: ti.template()):
+    for p, q in ti.ndrange(particles, particles):
+        if p != q:
+            coll_dist = coll_range * rad / width
+            eat_range = 40 * rad / width
+            i = diff_type[p]
+            iOther = diff_type[q]
+            dir = diff_pos[t, q] - diff_pos[t, p]
+            dist = ti.sqrt(dir.norm_sqr() + 1e-10)
+            
+            # Same type is repelled within range, otherwise the defined force applies
+            near = ti.select(i == iOther, smooth_step((coll_dist - dist) / diff_smoothing), 0.0)
+            scale = force_mult * diff_forces[i, iOther] * (1 - near) - diff_physics[2] * near
+            
+            # Particles does not interact with food before cooldown. Main particles feel no force from
+            # food within eat range, and the food is eaten by the alive main particles in range
+            if ti.static(hasValley):
+                food_on = diff_contact[None] >= 0 and tick - diff_contact[None] >= food_cooldown
+                eats = i == 0 and iOther == 1
+                scale *= ti.select(eats, ti.select(food_on, smooth_step((dist - eat_range) / diff_smoothing), 0.0), 1.0)
+                if i == 1 and iOther == 0 and food_on:
+                    diff_eat[t, p] += diff_alive[t, q] * smooth_step((eat_range - dist) / diff_smoothing)
+            
+            # Dead particles give no force
+            diff_acc[t, p] += diff_alive[t, q] * scale * dir / dist
+
+
+# Function for moving all particles from tick t to t + 1 of the segment with smooth surrogates
+@ti.kernel
+def diff_move(t: int, particles: int, hasValley: ti.template()):
+    for p in range(particles):
+        i = diff_type[p]
+        gravity = diff_physics[0]
+        max_speed = diff_physics[1]
         
-        # Update velocities
-        update_vel(0, max_speed, coll_force, gravity, amount)
+        # Apply force, then the smooth speed limit and gravity
+        vel = diff_vel[t, p] + diff_acc[t, p] / width
+        speed = ti.sqrt(vel.norm_sqr() + 1e-20)
+        vel *= max_speed / (speed ** 4 + max_speed ** 4) ** 0.25
+        vel += ti.Vector([0.0, -gravity * 0.015])
         
-        # Move alle particles
-        move_box(amount)
+        # Move and keep within the map
+        pos1 = diff_pos[t, p]
+        newPos = pos1 + vel
+        alive = diff_alive[t, p]
+        if ti.static(hasValley):
+            # Food has additional gravity to the right
+            if i == 1:
+                vel += ti.Vector([gravity * 0.015, 0.0])
+                newPos = pos1 + vel
+            
+            # Particles fade out at the bottom of the valley, and food fades out when eaten
+            alive *= smooth_step((newPos.y - 0.01) / diff_smoothing) * ti.exp(-diff_eat_rate * diff_eat[t, p])
+            
+            if pos1.x >= boxWidth and pos1.x <= 1-boxWidth and pos1.y < boxHeight:
+                newPos = ti.Vector([max(boxWidth, min(newPos.x, 1-boxWidth)), max(0.0, min(newPos.y, 1.0))])
+            elif pos1.x < boxWidth or pos1.x > 1-boxWidth:
+                newPos = ti.Vector([max(0.0, min(newPos.x, 1.0)), max(boxHeight, min(newPos.y, 1.0))])
+            else:
+                newPos = ti.Vector([max(0.0, min(newPos.x, 1.0)), max(0.0, min(newPos.y, 1.0))])
+        else:
+            newPos = ti.Vector([max(0.0, min(newPos.x, 1.0)), max(0.0, min(newPos.y, 1.0))])
         
-        # Draw all particles and map
-        render(hasValley=False)
+        diff_pos[t + 1, p] = newPos
+        diff_vel[t + 1, p] = vel
+        diff_alive[t + 1, p] = alive
 
 
-# ================================================================
-#         Code for Optuna Optimization - Reward functions
-# ================================================================
+# Function for simulating tick t -> t + 1 of the segment (The pair sums are cleared before the segment)
+def diff_step(t, tick, particles, hasValley):
+    diff_pair_forces(t, tick, particles, hasValley)
+    diff_move(t, particles, hasValley)
 
 
+# Function for setting the tick of the first ground contact (Not differentiated, the contact tick is fixed)
+@ti.kernel
+def diff_check_contact(t: int, tick: int, particles: int):
+    for p in range(particles):
+        if diff_contact[None] < 0 and diff_type[p] == 0 and diff_alive[t, p] > 0.5 and diff_pos[t, p].y <= boxHeight + 0.01:
+            ti.atomic_max(diff_contact[None], tick)
+
+
+# Function for the smooth valley reward of tick t: 100 per eaten food (1 - alive weight), and closeness
+# to the food for every alive main particle (The distance-based part of the reward)
+def diff_valley_reward(t, particles):
+    diff_food_distances(t, particles)
+    diff_valley_points(t, particles)
+
 
-# Function to count eaten food particles
+# Function for the distances of the main particles to the alive food in tick t
 @ti.kernel
-def cntEaten() -> int:
-    cnt = 0
-    
-    # Loop through food particles and accumulate for dead ones
-    for j in ti.ndrange(foodAmount):
-        if not alive[1, j]:
-            cnt += 1
-            
-    print("Eaten", cnt)
-    return cnt
+def diff_food_distances(t: int, particles: int):
+    for p, q in ti.ndrange(particles, particles):
+        if diff_type[p] == 0 and diff_type[q] == 1:
+            diff_food_dist[p] += diff_alive[t, q] * ti.sqrt((diff_pos[t, q] - diff_pos[t, p]).norm_sqr() + 1e-10)
+            diff_food_weight[p] += diff_alive[t, q]
 
 
-# Function to reward particle proximity to food
+# Function for the points of the valley reward of tick t
 @ti.kernel
-def particleCloseReward(maxPoints: int, amount: int) -> int: 
-    maxDist = ti.sqrt(2)        # Diagonal distance of GUI (Taichi GUI positions are defined from 0.0-1.0 in each dimension)
-    reward = 0.0
-    
-    # Loop through main particles
-    for j in ti.ndrange(amount):
-        
-        # Skip dead particles
-        if not alive[0, j]:
-            continue
-        
-        # Read particle position
-        particlePos = positions[0, j]
-        
-        distSum = 0.0
-        aliveCnt = 0
-        
-        # Loop through food particles
-        for jj in ti.ndrange(foodAmount):
-            # Skip dead particles
-            if alive[1, jj]:
-                foodPos = positions[1, jj]          # Read food position
-                dir = foodPos - particlePos         # Vector from current to other particle 
-                dist_sqr = dir.norm_sqr() + 1e-10       
-                dist = ti.sqrt(dist_sqr)            # Distance between particles
-                
-                # Accumulate distance and counter
-                distSum += dist
-                aliveCnt += 1
-        
-        # Compute average distance to food
-        avgDist = distSum / aliveCnt
-        
-        # Compare average distance to max possible distance and add reward
-        scaledDist = avgDist / maxDist
-        reward += (1 - scaledDist) * maxPoints
-        
-    print("ParticleCloseReward = ", reward)
-    return reward
+def diff_valley_points(t: int, particles: int):
+    for p in range(particles):
+        if diff_type[p] == 1:
+            diff_reward[None] += 100 * (1 - diff_alive[t, p])
+        else:
+            # When all food is eaten the particle gets full points
+            scaledDist = diff_food_dist[p] / (diff_food_weight[p] + 1e-6) / ti.sqrt(2)
+            diff_reward[None] += diff_alive[t, p] * (1 - scaledDist)
+
+
+# Function for the smooth clustering reward of tick t: average number of particles of the same
+# species within '5 * radius' (Each neighbor counts smoothly from 1 inside to 0 outside the range)
+@ti.kernel
+def diff_cluster_reward(t: int, particles: int):
+    for p, q in ti.ndrange(particles, particles):
+        if q != p and diff_type[q] == diff_type[p]:
+            cluster_range = 5 * rad / width
+            dist = ti.sqrt((diff_pos[t, q] - diff_pos[t, p]).norm_sqr() + 1e-10)
+            diff_reward[None] += smooth_step((cluster_range - dist) / diff_smoothing) / particles
+
+
+# Function for the gradient of the next segment times tick t (Its gradient is the gradient of the next segment)
+@ti.kernel
+def diff_adjoint_reward(t: int, particles: int):
+    for p in range(particles):
+        diff_reward[None] += diff_pos_adj[p].dot(diff_pos[t, p]) + diff_vel_adj[p].dot(diff_vel[t, p]) + diff_alive_adj[p] * diff_alive[t, p]
 
-# Function to compute average nearby particles
+
+# Function for keeping the gradient of the first tick of a segment for the segment before it
+@ti.kernel
+def diff_take_adjoint(particles: int):
+    for p in range(particles):
+        diff_pos_adj[p] = diff_pos.grad[0, p]
+        diff_vel_adj[p] = diff_vel.grad[0, p]
+        diff_alive_adj[p] = diff_alive.grad[0, p]
+
+
+# Function for loading a checkpoint as the first tick of the segment
 @ti.kernel
-def clustering_level_max(range: float, amount: int) -> float:
-    in_range_sum = 0
+def diff_load(pos: ti.types.ndarray(), vel: ti.types.ndarray(), alive: ti.types.ndarray(), particles: int):
+    for p in range(particles):
+        diff_pos[0, p] = ti.Vector([pos[p, 0], pos[p, 1]])
+        diff_vel[0, p] = ti.Vector([vel[p, 0], vel[p, 1]])
+        diff_alive[0, p] = alive[p]
+
+
+# Function for clearing the pair sums before a segment is simulated
+def clear_diff_sums():
+    diff_acc.fill(0)
+    diff_eat.fill(0)
+    diff_food_dist.fill(0)
+    diff_food_weight.fill(0)
+
+
+# Function for the state of tick t as numpy arrays (A checkpoint)
+def diff_state(t):
+    return diff_pos.to_numpy()[t], diff_vel.to_numpy()[t], diff_alive.to_numpy()[t]
+
+
+# Function for the reward of the differentiable simulation and its gradient with respect to the forces and physics
+# (Through the last 'horizon' ticks). The ticks are simulated once to store a checkpoint at the start of every
+# segment, then the segments of the horizon are simulated again from the last to the first, each inside a tape
+# that gives the gradient of its first tick. Raises when the gradient is not finite
+def diff_gradient(state, hasValley, ticks, segment, horizon):
+    particles = len(state[2])
+    first = max(0, ticks - horizon)
+    starts = list(range(0, first, segment)) + list(range(first, ticks, segment))
+    ends = starts[1:] + [ticks]
     
-    # Loop through particles
-    for j in ti.ndrange(amount):
-        
-        # Get particle position
-        pos1 = positions[0, j]
-        cnt = 0
-        
-        # Loop throgh all particles
-        for jj in ti.ndrange(amount):
-            # The particle skips itself
-            if j == jj:
-                continue
-            
-            pos2 = positions[0, jj]             # Get other particle position
-            dir =  pos2 - pos1                  # Vector from current to other particle 
-            dist_sqr = dir.norm_sqr() + 1e-10
-            dist = ti.sqrt(dist_sqr)            # Distance between particles
-            
-            # Accumulate count if withing range
-            if dist < range:
-                cnt += 1
-        # Add count to sum
-        in_range_sum += cnt
+    # Forward pass (Only the checkpoints are kept)
+    diff_contact[None] = -1 if hasValley else 0
+    checkpoints = []
+    diff_load(*state, particles)
+    for start, end in zip(starts, ends):
+        checkpoints.append(diff_state(0))
+        clear_diff_sums()
+        for t in range(end - start):
+            diff_step(t, start + t, particles, hasValley)
+            if hasValley:
+                diff_check_contact(t + 1, start + t + 1, particles)
+        diff_load(*diff_state(end - start), particles)
+    
+    # Backward pass through the segments of the horizon (The reward of the last segment is the reward of the simulation)
+    forces_grad = np.zeros((types, types))
+    physics_grad = np.zeros(3)
+    value = 0.0
+    for s in reversed(range(starts.index(first), len(starts))):
+        length = ends[s] - starts[s]
+        diff_load(*checkpoints[s], particles)
+        clear_diff_sums()
+        diff_reward[None] = 0.0
+        with ti.ad.Tape(loss=diff_reward):
+            for t in range(length):
+                diff_step(t, starts[s] + t, particles, hasValley)
+            if s < len(starts) - 1:
+                diff_adjoint_reward(length, particles)
+            elif hasValley:
+                diff_valley_reward(length, particles)
+            else:
+                diff_cluster_reward(length, particles)
         
-    # Print and return the average particles within range     
-    print("Average particles in range", range, ":", in_range_sum / amount)
-    return in_range_sum / amount
-
+        if s == len(starts) - 1:
+            value = diff_reward[None]
+        forces_grad += diff_forces.grad.to_numpy()
+        physics_grad += diff_physics.grad.to_numpy()
+        diff_take_adjoint(particles)
+    
+    if not (np.all(np.isfinite(forces_grad)) and np.all(np.isfinite(physics_grad))):
+        raise RuntimeError(f"The gradient through the last {horizon} ticks is not finite (Try a lower --grad-horizon or a higher --grad-smooth)")
+    return value, forces_grad, physics_grad
 
 
-# ================================================================
-#         Code for Optuna Optimization - Studies and objective functions
-# ================================================================
-            
+# Function for the initial state of simulation 0 as one list of particles (Positions, velocities, alive weights and types)
+def diff_initial_state(amount):
+    pos = positions.to_numpy()[0]
+    vel = velocities.to_numpy()[0]
+    is_alive = alive_to_numpy()[0]
+    
+    state_pos, state_vel, state_type = [], [], []
+    for i in range(types):
+        for j in range(capacity):
+            if is_alive[i, j]:
+                state_pos.append(pos[i, j])
+                state_vel.append(vel[i, j])
+                state_type.append(i)
+    
+    state = (np.array(state_pos, dtype=np_float), np.array(state_vel, dtype=np_float), np.ones(len(state_type), dtype=np_float))
+    return state, np.array(state_type, dtype=np.int32)
 
 
-# Objective function for training on valley map
-def objective_forces_valley(trial):
-    # Optuna suggests force values for main particle
-    force_00 = trial.suggest_float('force_00', 0.1, 1.0)
-    force_01 = trial.suggest_float('force_01', -1.0, 1.0)
-    amount = trial.suggest_int('Particles', 0, 200)
+# Function for starting simulation 0 on a map with 'amount' particles and allocating the differentiable
+# simulation for it. Returns the initial state, and the names, ranges (The ranges of the Optuna studies)
+# and values of the tuned parameters
+def diff_setup(hasValley, amount, segment, layout_seed=None):
+    if hasValley:
+        initValley(amount, 0, layout_seed)
+        names = ["force_00", "force_01"]
+        low = np.array([0.1, -1.0])
+        high = np.array([1.0, 1.0])
+        params = np.array([forces[0, 0, 0], forces[0, 0, 1]])
+    else:
+        initBox(amount, 0, layout_seed)
+        names = ["gravity", "max_speed", "coll_force"]
+        low = np.array([0.0, 0.0001, 0.0])
+        high = np.array([0.2, 0.08, 1000.0])
+        params = np.array([glob_gravity, glob_max_speed, glob_coll_force])
     
-    # Reset the simulation to the initial state
-    initValley(amount)
+    state, state_type = diff_initial_state(amount)
+    allocate_diff_fields(len(state_type), segment)
+    diff_type.from_numpy(state_type)
+    diff_forces.from_numpy(forces.to_numpy()[0])
+    return state, names, low, high, params
 
-    # Apply suggestions to force field
-    forces[0, 0] = force_00
-    forces[0, 1] = force_01
 
-    # Get physics variables
-    gravity = glob_gravity
-    max_speed = glob_max_speed
-    coll_force = glob_coll_force
+# Function for setting the tuned parameters of the differentiable simulation (Forces on the valley map, physics on the box map)
+def diff_set_params(hasValley, params):
+    physics = params
+    if hasValley:
+        diff_forces[0, 0] = params[0]
+        diff_forces[0, 1] = params[1]
+        physics = np.array([glob_gravity, glob_max_speed, glob_coll_force])
+    diff_physics.from_numpy(np.array(physics, dtype=np_float))
+
+
+# Function for the gradient of the reward with respect to the tuned parameters (In the unit range of every parameter)
+def diff_param_gradient(hasValley, forces_grad, physics_grad, low, high):
+    grad = np.array([forces_grad[0, 0], forces_grad[0, 1]]) if hasValley else physics_grad
+    return grad * (high - low)
+
+
+# Training function that tunes the forces (Valley map) or physics (Box map) by gradient ascent on the
+# differentiable simulation. The result is then simulated exactly as a trial of the Optuna study,
+# so it can be compared with the trials found by Optuna
+def train_gradient(hasValley, iterations):
+    ticks = args.grad_ticks if args.grad_ticks > 0 else (4000 if hasValley else 2000)
+    segment = min(args.grad_segment, ticks)
+    horizon = max(1, min(args.grad_horizon, ticks))
+    amount = 200 if hasValley else 500
+    state, names, low, high, params = diff_setup(hasValley, amount, segment, seed)
     
-    # Values for loop (Ticker starts after a particle touches ground)
-    total_reward = 0.0
-    tickCount = 0
-    hasTouchedGround = False
-    cnt = 0
-    
-    # Run the simulation for N steps / ticks
-    for step in range(4000):
-        # Check for ground contact
-        if not hasTouchedGround:
-            hasTouchedGround = checkTouchGround(amount)
-        # Start counter after contact
-        else:
-            tickCount += 1
+    # Adam steps in the unit range of every parameter. The gradient only sees the last ticks, so a step
+    # can lower the reward: the ascent then goes back to the best parameters with half the step size
+    unit = (params - low) / (high - low)
+    m = np.zeros_like(unit)
+    v = np.zeros_like(unit)
+    lr = args.grad_lr
+    best_value, best_params, best_grad = -np.inf, params.copy(), None
+    for iteration in range(1, iterations + 1):
+        params = low + unit * (high - low)
+        diff_set_params(hasValley, params)
+        value, forces_grad, physics_grad = diff_gradient(state, hasValley, ticks, segment, horizon)
         
-        # Update velocities
-        update_vel(tickCount, max_speed, coll_force, gravity, amount)
+        # Food only interacts 'food_cooldown' ticks after ground contact, so shorter runs have no gradient for force_01
+        contact = diff_contact[None]
+        if hasValley and iteration == 1 and (contact < 0 or contact + food_cooldown >= ticks):
+            reach = f"ground contact (Tick {contact}) plus {food_cooldown}" if contact >= 0 else f"ground contact plus {food_cooldown} (No contact yet)"
+            print(f"Warning: --grad-ticks {ticks} is shorter than {reach} ticks, so food never interacts and the gradient of force_01 is 0")
+        grad = diff_param_gradient(hasValley, forces_grad, physics_grad, low, high)
+        print(f"Iteration {iteration}: surrogate reward {value:.3f}, " + ", ".join(f"{name} = {param:.5g}" for name, param in zip(names, params)))
         
-        # Move all particles
-        move_valley(amount)
+        if value > best_value:
+            best_value, best_params, best_grad = value, params.copy(), grad
+        else:
+            unit = (best_params - low) / (high - low)
+            grad = best_grad
+            lr /= 2
         
-        cnt += 1
-        if cnt % 4 == 0 and drawing == 1:
-            render(True)
-
-    # Add reward for amount of food particles eaten
-    total_reward += cntEaten() * 100
+        m = 0.9 * m + 0.1 * grad
+        v = 0.999 * v + 0.001 * grad ** 2
+        step = lr * (m / (1 - 0.9 ** iteration)) / (np.sqrt(v / (1 - 0.999 ** iteration)) + 1e-8)
+        unit = np.clip(unit + step, 0.0, 1.0)
+    
+    # Simulate the best parameters exactly as a trial of the study
+    trial_params = dict(zip(names, best_params.tolist()))
+    if hasValley:
+        trial_params["Particles"] = amount
+        study_name, objective, objective_batch = "Valley", objective_forces_valley, objective_forces_valley_batch
+    else:
+        trial_params["coll_force"] = int(round(trial_params["coll_force"]))
+        study_name, objective, objective_batch = "Clusterization", objective_clusterization_box, objective_clusterization_box_batch
+    
+    # Every iteration simulates all ticks once, and the horizon again forward and backward
+    simulations = round(iterations * (ticks + 2 * horizon) / ticks, 1)
+    study = optuna.create_study(direction='maximize', storage=get_storage(), study_name=study_name, sampler=get_sampler(), load_if_exists=True)
+    study.enqueue_trial(trial_params, user_attrs={
+        "gradient_iterations": iterations,
+        "gradient_ticks": ticks,
+        "gradient_horizon": horizon,
+        "gradient_surrogate": best_value,
+        "gradient_simulations": simulations
+        })
+    optimize(study, objective, objective_batch, 1)
     
-    # Add reward for proximity to food for alive none-food-particles
-    total_reward += particleCloseReward(1, amount)
+    trial = study.trials[-1]
+    print(f"Gradient ascent: {iterations} iterations (About {simulations} simulations)")
+    print(f" Value: {trial.value}")
+    print("  Params: ")
+    for key, value in trial.params.items():
+        print(f"    {key}: {value}")
 
-    # Return total reward
-    return total_reward
 
+# ================================================================
+#         Benchmark
+# ================================================================
 
 
 
+# Function for the particle amounts of a benchmark (Doubles until max_amount)
+def benchmark_amounts(max_amount):
+    amounts = []
+    amount = 250
+    while amount < max_amount:
+        amounts.append(amount)
+        amount *= 2
+    amounts.append(max_amount)
+    return amounts
 
-# Objective function for training on valley map without gravity
-def objective_forces_valley_zeroG(trial):
-    # Optuna suggests force values for main particle
-    force_00 = trial.suggest_float('force_00', 0.1, 1.0)
-    force_01 = trial.suggest_float('force_01', -1.0, 1.0)
-    amount = trial.suggest_int('Particles', 0, 200)
+
+# Function for timing ticks of the velocity update engines on the box map
+def benchmark_engines(max_amount, ticks=50):
+    global engine
+    selected = engine
+    amounts = benchmark_amounts(max_amount)
+    previous = {}
     
-    # Reset the simulation to the initial state
-    initValley(amount)
+    # Scaling is the exponent of the tick time against the previous amount (1 = linear, 2 = quadratic)
+    print(f"Grid engine: cutoff {max(interaction_cutoff, coll_range * rad / width):.3f}, {grid_res} x {grid_res} cells")
+    print(f"{'Particles':>10} {'Engine':>11} {'Ticks/sec':>12} {'us/particle':>12} {'Fused t/s':>12} {'Scaling':>8}")
+    for amount in amounts:
+        for name in ["exact", "grid", "barnes_hut"]:
+            engine = name
+            for b in range(batch_size):
+                initBox(amount, b)
+                set_physics(b, glob_gravity, glob_max_speed, glob_coll_force)
+            
+            # Warm up (Compiles kernels)
+            for step in range(3):
+                update_velocities(amount)
+                move_box(amount, kernel_config(False))
+            ti.sync()
+            
+            # Time the ticks
+            start = time.perf_counter()
+            for step in range(ticks):
+                update_velocities(amount)
+                move_box(amount, kernel_config(False))
+            ti.sync()
+            tick_time = (time.perf_counter() - start) / ticks
+            
+            # Time the same ticks fused into few kernel launches
+            step_simulations(ticks, amount, hasValley=False)
+            ti.sync()
+            start = time.perf_counter()
+            step_simulations(ticks, amount, hasValley=False)
+            ti.sync()
+            fused_time = (time.perf_counter() - start) / ticks
+            
+            scaling = ""
+            if name in previous:
+                scaling = f"{np.log(fused_time / previous[name][1]) / np.log(amount / previous[name][0]):.2f}"
+            previous[name] = (amount, fused_time)
+            
+            print(f"{amount:>10} {name:>11} {1 / tick_time:>12.1f} {tick_time / amount * 1e6:>12.3f} {1 / fused_time:>12.1f} {scaling:>8}")
+        
+        # Accuracy of the Barnes-Hut engine compared to the exact engine
+        mean_error, max_error = barnes_hut_drift(amount)
+        print(f"{'':>10} Barnes-Hut drift (theta = {bh_theta}): mean {mean_error:.4f}, max {max_error:.4f}")
+    
+    engine = selected
 
-    # Apply suggestions to force field
-    forces[0, 0] = force_00
-    forces[0, 1] = force_01
 
-    # Get physics variables
-    gravity = 0
-    max_speed = glob_max_speed
-    coll_force = glob_coll_force
+# Function for timing ticks of the valley map with the layout given on the command line.
+# Prints the memory of the particle state and the ticks/sec as JSON (Run by 'benchmark_layouts')
+def measure_layout(amount, ticks=200):
+    for b in range(batch_size):
+        initValley(amount, b, 0)
+        set_physics(b, glob_gravity, glob_max_speed, glob_coll_force)
     
-    # Values for loop (Ticker starts after a particle touches ground)
-    total_reward = 0.0
-    tickCount = 0
-    cnt = 0
+    # Warm up (Compiles the kernels of all chunks)
+    step_simulations(ticks, amount, hasValley=True)
+    ti.sync()
     
-    # Run the simulation for N steps / ticks
-    for step in range(4000):
-        # counter (Not necessary to check for ground contact)
-        tickCount += 1
-        
-        # Update velocities
-        update_vel(tickCount, max_speed, coll_force, gravity, amount)
-        
-        # Move all particles
-        move_valley(amount)
-        
-        cnt += 1
-        if cnt % 4 == 0 and drawing == 1:
-            render(True)
-
-    # Add reward for amount of food particles eaten
-    total_reward += cntEaten() * 100
+    start = time.perf_counter()
+    step_simulations(ticks, amount, hasValley=True)
+    ti.sync()
+    tick_time = (time.perf_counter() - start) / ticks
     
-    # Add reward for proximity to food for alive none-food-particles
-    total_reward += particleCloseReward(1, amount)
+    print(json.dumps({"bytes": state_bytes(), "ticks_per_sec": 1 / tick_time}))
 
-    # Return total reward
-    return total_reward
 
+# Function for comparing all layouts of the particle state on the valley map. Every layout runs
+# in its own process, since the fields can only be declared once
+def benchmark_layouts(amount):
+    print(f"{'Layout':>7} {'State':>6} {'Alive':>7} {'Capacity':>9} {'Memory KB':>10} {'Ticks/sec':>10}")
+    for layout_name in ["soa", "aos"]:
+        for precision in ["f32", "f64"]:
+            for packed in [False, True]:
+                for type_capacity_flag in [False, True]:
+                    command = [sys.executable, __file__, "layout-run", "0", str(amount), "0", "--headless",
+                        "--arch", args.arch, "--layout", layout_name, "--state-precision", precision]
+                    if args.threads is not None:
+                        command += ["--threads", str(args.threads)]
+                    if packed:
+                        command.append("--packed-alive")
+                    if type_capacity_flag:
+                        command.append("--type-capacity")
+                    
+                    output = subprocess.run(command, capture_output=True, text=True).stdout.strip().splitlines()
+                    result = json.loads(output[-1])
+                    print(f"{layout_name:>7} {precision:>6} {'bits' if packed else 'bool':>7} {'type' if type_capacity_flag else 'shared':>9} "
+                          f"{result['bytes'] / 1024:>10.1f} {result['ticks_per_sec']:>10.1f}")
 
 
 
+# Function for the mean time of a call in seconds (Called once before, so kernels are compiled)
+def time_call(function, repeats):
+    function()
+    ti.sync()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    ti.sync()
+    return (time.perf_counter() - start) / repeats
 
 
-# Objective function for training on box map
-def objective_clusterization_box(trial):
-    # Optuna suggests physics variable values
-    gravity = trial.suggest_float('gravity', 0.0, 0.2)
-    coll_force = trial.suggest_int('coll_force', 0, 1000)
-    max_speed = trial.suggest_float('max_speed', 0.0001, 0.08)
+# Function for running the benchmarks of one arch and thread count. Prints all results as JSON
+# (Run by 'benchmark_suite', since Taichi can only be initialized once per process)
+def run_benchmark_suite(max_amount, repeats=20, ticks=64):
+    threads = args.threads if args.threads is not None else "default"
+    results = []
     
-    # Ammount of particles
-    amount = 500
+    def add(map_name, amount, name, seconds):
+        results.append({"arch": args.arch, "threads": threads, "map": map_name, "amount": amount, "name": name, "seconds": seconds})
     
-    # Reset the simulation to the initial state
-    initBox(amount)
+    for amount in benchmark_amounts(max_amount):
+        # Kernels of the valley map (Every measurement starts from the initial layout)
+        initValley(amount, 0, 0)
+        set_physics(0, glob_gravity, glob_max_speed, glob_coll_force)
+        add("valley", amount, "update_vel", time_call(lambda: update_velocities(amount), repeats))
+        initValley(amount, 0, 0)
+        add("valley", amount, "move_valley", time_call(lambda: move_valley(amount, kernel_config(True)), repeats))
+        add("valley", amount, "rewards", time_call(lambda: rewards_forces_valley(amount), repeats))
+        initValley(amount, 0, 0)
+        add("valley", amount, "tick", time_call(lambda: step_simulations(ticks, amount, hasValley=True), 1) / ticks)
+        
+        # Kernels of the box map
+        initBox(amount, 0, 0)
+        set_physics(0, glob_gravity, glob_max_speed, glob_coll_force)
+        add("box", amount, "update_vel", time_call(lambda: update_velocities(amount), repeats))
+        add("box", amount, "move_box", time_call(lambda: move_box(amount, kernel_config(False)), repeats))
+        add("box", amount, "rewards", time_call(lambda: rewards_clusterization_box(amount), repeats))
+        initBox(amount, 0, 0)
+        add("box", amount, "tick", time_call(lambda: step_simulations(ticks, amount, hasValley=False), 1) / ticks)
     
-    # Values for loop
-    total_reward = 0.0
-    cnt = 0
+    # Complete objective evaluations with fixed parameters
+    valley_trial = optuna.trial.FixedTrial({"force_00": 0.5, "force_01": 0.5, "Particles": 100})
+    box_trial = optuna.trial.FixedTrial({"gravity": 0.1, "coll_force": 300, "max_speed": 0.01})
+    start = time.perf_counter()
+    objective_forces_valley_batch([valley_trial])
+    add("valley", 100, "objective", time.perf_counter() - start)
+    start = time.perf_counter()
+    objective_clusterization_box_batch([box_trial])
+    add("box", 500, "objective", time.perf_counter() - start)
     
-    # Run the simulation for N steps / ticks
-    for step in range(2000):
-        # Update velocities
-        update_vel(0, max_speed, coll_force, gravity, amount)
-        
-        # Move all particles
-        move_box(amount)
-        
-        cnt += 1
-        if cnt % 3 == 0 and drawing == 1:
-            render(False)
+    # Peak memory of the process (Not measured where the 'resource' module is missing, like on Windows)
+    # and memory of the particle state
+    peak = peak_memory()
+    if peak is not None:
+        results.append({"arch": args.arch, "threads": threads, "map": "all", "amount": max_amount, "name": "peak_memory", "bytes": peak})
+    results.append({"arch": args.arch, "threads": threads, "map": "all", "amount": max_amount, "name": "state_memory", "bytes": state_bytes()})
+    
+    print(json.dumps(results))
 
-    # Add reward for average number of particles within '5 * radius'
-    total_reward += clustering_level_max((5 * rad) / width, amount)
 
-    # Return total reward
-    return total_reward
+# Function for the peak memory of the process in bytes (None where it can not be measured). The
+# maximum resident set size is in bytes on macOS and in kilobytes on other systems
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
 
 
-# Training function for valley map
-def train_forces_valley(trials):
-    # Create study
-    study = optuna.create_study(
-        direction='maximize', 
-        storage="sqlite:///db.sqlite3", 
-        study_name="Valley", 
-        load_if_exists=True
-        )
-    
-    # # Optimize study with objective function
-    study.optimize(objective_forces_valley, n_trials=trials)
+# Function for the value of a benchmark result as text
+def format_result(result):
+    if "bytes" in result:
+        return f"{result['bytes'] / 2**20:.2f} MB"
+    if result["name"] == "tick":
+        return f"{1 / result['seconds']:.1f} ticks/sec"
+    return f"{result['seconds'] * 1000:.3f} ms"
 
-    # Print best result and parameter values:
-    print("Best trial:")
-    trial = study.best_trial
 
-    print(f" Value: {trial.value}")
-    print("  Params: ")
-    for key, value in trial.params.items():
-        print(f"    {key}: {value}")
+# Function for comparing benchmark results with a baseline. A result is a regression when it is
+# more than 'bench_tolerance' slower (or larger) than the baseline. Returns the number of regressions
+def compare_benchmarks(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
     
-    # Draw visualizations
-    optuna.visualization.plot_parallel_coordinate(study, params=['force_00', 'force_01', 'Particles']).show()
-    
-    # Create study for zero gravity simulation
-    study2 = optuna.create_study(
-        direction='maximize', 
-        storage="sqlite:///db.sqlite3", 
-        study_name="Valley_ZeroG", 
-        load_if_exists=True
-        )
+    key = lambda result: (result["arch"], str(result["threads"]), result["map"], result["amount"], result["name"])
+    old_results = {key(result): result for result in baseline}
     
-    # Optimize study with objective function
-    study2.optimize(objective_forces_valley_zeroG, n_trials=100)
+    regressions = 0
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = old_results.get(key(result))
+        if old is None:
+            continue
+        unit = "bytes" if "bytes" in result else "seconds"
+        change = result[unit] / max(old[unit], 1e-12) - 1
+        flag = ""
+        if change > args.bench_tolerance:
+            flag = "REGRESSION"
+            regressions += 1
+        print(f"{result['arch']:>7} {str(result['threads']):>8} {result['map']:>7} {result['amount']:>7} {result['name']:>13} "
+              f"{format_result(old):>20} {format_result(result):>20} {change * 100:>+8.1f}% {flag}")
     
-    # Draw visualizations
-    optuna.visualization.plot_parallel_coordinate(study2, params=['force_00', 'force_01', 'Particles']).show()
+    print(f"{regressions} regressions (Tolerance {args.bench_tolerance * 100:.0f}%)")
+    return regressions
+
+
+# Function for the benchmark suite. Every arch and thread count runs in its own process, and all
+# results are saved as JSON. With a baseline, the results are compared and regressions are flagged
+def benchmark_suite(max_amount):
+    bench_archs = (args.bench_archs or args.arch).split(",")
+    bench_threads = args.bench_threads.split(",") if args.bench_threads else [None]
     
+    # Options of the simulation are the same in every process
+    options = ["--precision", args.precision, "--layout", args.layout]
+    if args.state_precision is not None:
+        options += ["--state-precision", args.state_precision]
+    if args.packed_alive:
+        options.append("--packed-alive")
+    if args.type_capacity:
+        options.append("--type-capacity")
     
-  
-# Training function for box map    
-def train_clusterization_box(trials):
-    # Create study
-    study = optuna.create_study(
-        direction='maximize', 
-        storage="sqlite:///db.sqlite3", 
-        study_name="Clusterization", 
-        load_if_exists=True
-        )
+    results = []
+    for arch in bench_archs:
+        for threads in bench_threads:
+            command = [sys.executable, __file__, "suite-run", "0", str(max_amount), "0", "--headless", "--arch", arch] + options
+            if threads is not None:
+                command += ["--threads", threads]
+            
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"Benchmark on {arch} with {threads or 'default'} threads failed:\n{completed.stderr[-2000:]}")
+                continue
+            results += json.loads(completed.stdout.strip().splitlines()[-1])
     
-    # Optimize study with objective function
-    study.optimize(objective_clusterization_box, n_trials=trials)
-
-    # Print best result and parameter values:
-    print("Best trial:")
-    trial = study.best_trial
-    print(f" Value: {trial.value}")
-    print("  Params: ")
-    for key, value in trial.params.items():
-        print(f"    {key}: {value}")
+    print(f"{'Arch':>7} {'Threads':>8} {'Map':>7} {'Amount':>7} {'Name':>13} {'Result':>20}")
+    for result in results:
+        print(f"{result['arch']:>7} {str(result['threads']):>8} {result['map']:>7} {result['amount']:>7} {result['name']:>13} {format_result(result):>20}")
     
-    # Draw visualizations
-    optuna.visualization.plot_slice(study, params=['gravity', 'coll_force', 'max_speed']).show()
-    optuna.visualization.plot_param_importances(study, params=['gravity', 'coll_force', 'max_speed']).show()
-     
+    with open(args.bench_out, "w") as file:
+        json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "options": options, "results": results}, file, indent=1)
+    print(f"Results saved to {args.bench_out}")
+    
+    if args.bench_compare is not None and compare_benchmarks(results, args.bench_compare) > 0:
+        sys.exit(1)
+
         
 # train_forces_valley()
 # train_clusterization_box()
 # run_valley()
 # run_box()
 
+# ================================================================
+#         Simulation engine (Used when main.py is imported)
+# ================================================================
+
+
+# Function for the particle amount the fields are sized for (The next power of two, at least 64). Field sizes
+# are compiled into the kernels, so nearby amounts share the same fields and load the same cached kernels
+def field_size(amount):
+    size = 64
+    while size < amount:
+        size *= 2
+    return size
+
+
+# Function for setting the number of particles, species and simulations. Taichi is started again
+# with new fields when they do not fit in the current fields, or when it runs with other options
+def resize_fields(amount, species_count, simulations, map_name, options=None):
+    global glob_amount, species, types, capacity, batch_size, trial_batch_size, field_amount, field_maps
+    if max(2, species_count) > len(colors):
+        raise ValueError(f"At most {len(colors)} species are supported")
+    
+    counts = capacities_for(amount, [map_name], species_count)
+    fits = taichi_started and max(2, species_count) == types and simulations == batch_size
+    fits = fits and (options is None or options == taichi_options)
+    fits = fits and all(count <= type_capacities[i] for i, count in enumerate(counts))
+    glob_amount = amount
+    species = species_count
+    if not fits:
+        types = max(2, species_count)
+        field_amount = field_size(amount)
+        field_maps = [map_name]
+        capacity = max(capacities_for(field_amount, field_maps, species_count))
+        batch_size = simulations
+        trial_batch_size = simulations
+        start_taichi(options)
+
+
+# Simulation with explicit settings that can be used from notebooks, tests and other programs:
+#
+#   import main
+#   sim = main.Simulation("box", particles=2000, species=3, seed=1)
+#   sim.step(1000)
+#   print(sim.reward())
+#
+# The simulation owns the fields of main.py (One simulation at a time, a new one replaces the fields
+# of the old one, and the old one raises when it is used). Its settings stay in the simulation: the
+# Taichi options, the engine, early stopping and the ticks per launch are handed to the functions it
+# calls, and only the sizes of the fields are set in main.py. Compiled kernels are kept in 'kernel_cache',
+# so later processes skip compiling (Kernels are still traced in every process)
+simulation_generation = 0           # Number of the simulation that owns the fields
+
+
+class Simulation:
+    def __init__(self, map_name="box", particles=500, species=1, batch=1, gravity=glob_gravity, max_speed=glob_max_speed,
+                 coll_force=glob_coll_force, seed=None, arch="cpu", threads=None, kernel_cache="kernel_cache", fused_ticks=1,
+                 engine="exact", early_stop=False):
+        global simulation_generation
+        if map_name not in ["valley", "box"]:
+            raise ValueError("map_name must be 'valley' or 'box'")
+        if engine not in ["exact", "grid", "barnes_hut"]:
+            raise ValueError("engine must be 'exact', 'grid' or 'barnes_hut'")
+        if map_name == "valley" and species != 1:
+            raise ValueError("The valley map has one species")
+        
+        self.map_name = map_name
+        self.gravity = gravity
+        self.max_speed = max_speed
+        self.coll_force = coll_force
+        self.seed = seed
+        self.engine = engine
+        self.early_stop = early_stop
+        
+        # Short runs start faster with few ticks per launch (The ticks of a launch are unrolled when compiling)
+        self.fused_ticks = fused_ticks
+        
+        # Options of the Taichi runtime
+        self.init_options = dict(init_options, arch=archs[arch], offline_cache_file_path=os.path.abspath(kernel_cache))
+        if threads is not None:
+            self.init_options["cpu_max_num_threads"] = threads
+        
+        # The new simulation takes over the fields
+        simulation_generation += 1
+        self.generation = simulation_generation
+        self.resize(particles, species, batch)
+    
+    # Function for checking that this simulation still owns the fields
+    def check_owner(self):
+        if self.generation != simulation_generation:
+            raise RuntimeError("This Simulation was replaced by a newer Simulation, which owns the fields now")
+    
+    # Function for changing the number of particles, species or simulations (Without restarting the process).
+    # All simulations start again from their initial layouts
+    def resize(self, particles=None, species=None, batch=None):
+        self.check_owner()
+        self.particles = particles if particles is not None else self.particles
+        self.species = species if species is not None else self.species
+        self.batch = batch if batch is not None else self.batch
+        resize_fields(self.particles, self.species, self.batch, self.map_name, self.init_options)
+        self.reset()
+    
+    # Function for starting all simulations from their initial layouts (Simulation b uses seed + b)
+    def reset(self, seed=None):
+        self.check_owner()
+        if seed is not None:
+            self.seed = seed
+        
+        for b in range(self.batch):
+            layout_seed = self.seed + b if self.seed is not None else None
+            if self.map_name == "valley":
+                initValley(self.particles, b, layout_seed)
+            else:
+                initBox(self.particles, b, layout_seed)
+            set_physics(b, self.gravity, self.max_speed, self.coll_force)
+    
+    # Function for running N ticks of all simulations (With the engine of this simulation, and with
+    # 'early_stop' finished simulations stop moving)
+    def step(self, ticks):
+        self.check_owner()
+        hasValley = self.map_name == "valley"
+        config = kernel_config(hasValley, self.engine, self.early_stop)
+        step_simulations(ticks, self.particles, hasValley, config, self.fused_ticks)
+    
+    # Function for the reward of every simulation (The objective of the map)
+    def reward(self):
+        self.check_owner()
+        if self.map_name == "valley":
+            return rewards_forces_valley(self.particles)
+        return rewards_clusterization_box(self.particles)
+    
+    # Function for the positions of the alive particles of simulation b (One array per type)
+    def particle_positions(self, b=0):
+        self.check_owner()
+        pos = positions.to_numpy()[b]
+        is_alive = alive_to_numpy()[b]
+        return [pos[i, :capacity][is_alive[i]] for i in range(types)]
+    
+    # Function for the ticks counted by every simulation (After ground contact on the valley map)
+    def ticks(self):
+        self.check_owner()
+        return tick_count.to_numpy()
+
+
+# Launches of all kernels are watched when profiling (After all kernels are defined)
+if profiling:
+    profile_kernels()
+
+
 if __name__ == "__main__":
     # Check if argument 2, 3 and 4 is allowed
     if training != 0 and training != 1:
@@ -663,9 +4301,19 @@ if __name__ == "__main__":
         print("Third argument must be at least 1")
     if drawing != 0 and drawing != 1:
         print("Fourth argument must be 1 or 0")
+    if headless and (training == 0 or args.replay is not None) and map not in ["bench", "layouts", "layout-run", "suite", "suite-run"] and args.export is None:
+        print("The regular simulation must be drawn and can not run with --headless")
+        sys.exit(1)
     
     # Run function based on arguments
-    if map == "valley":
+    if args.replay is not None:
+        replay(args.replay)
+    
+    # Gradient ascent on the differentiable simulation (arg3 is the number of iterations)
+    elif training == 1 and args.gradient and map in ["valley", "box"]:
+        train_gradient(map == "valley", trials)
+    
+    elif map == "valley":
         if training == 1:
             train_forces_valley(trials)
         else:
@@ -676,5 +4324,21 @@ if __name__ == "__main__":
             train_clusterization_box(trials)
         else:
             run_box()
+    
+    # Benchmark of the engines (arg3 is the largest particle amount)
+    elif map == "bench":
+        benchmark_engines(trials)
+    
+    # Benchmark of the particle state layouts (arg3 is the particle amount)
+    elif map == "layouts":
+        benchmark_layouts(trials)
+    elif map == "layout-run":
+        measure_layout(trials)
+    
+    # Benchmark suite of kernels and objectives (arg3 is the largest particle amount)
+    elif map == "suite":
+        benchmark_suite(trials)
+    elif map == "suite-run":
+        run_benchmark_suite(trials)
     else:
-        print("First argument must be 'valley' or 'box'")
\ No newline at end of file
+        print("First argument must be 'valley', 'box', 'bench', 'layouts' or 'suite'")
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+import main
+
+
+# Function for the positions of all particles of every simulation
+def all_positions(sim):
+    return [sim.particle_positions(b) for b in range(sim.batch)]
+
+
+# Batched simulations give the same particles and rewards as the same simulations run alone
+def test_batched_equals_single():
+    sim = main.Simulation("box", particles=100, batch=3, seed=1)
+    sim.step(64)
+    batched = all_positions(sim)
+    rewards = sim.reward()
+    
+    for b in range(3):
+        single = main.Simulation("box", particles=100, batch=1, seed=1 + b)
+        single.step(64)
+        for i in range(main.types):
+            np.testing.assert_array_equal(single.particle_positions()[i], batched[b][i])
+        assert single.reward()[0] == rewards[b]
+
+
+# The same seed always gives the same layout, also after resizing, and other seeds give other layouts
+def test_layouts_agree():
+    sim = main.Simulation("valley", particles=60, seed=3)
+    first = sim.particle_positions()
+    
+    sim.resize(particles=60, batch=2)
+    for i in range(main.types):
+        np.testing.assert_array_equal(sim.particle_positions()[i], first[i])
+    
+    sim.reset(seed=4)
+    assert not np.array_equal(sim.particle_positions()[0], first[0])
+
+
+# Detecting finished simulations on the device does not change the simulation or its reward
+def test_reward_with_monitor():
+    results = []
+    for early_stop in [False, True]:
+        sim = main.Simulation("valley", particles=60, seed=1, early_stop=early_stop)
+        sim.step(400)
+        results.append((sim.reward(), sim.particle_positions()[0]))
+    
+    np.testing.assert_array_equal(results[0][0], results[1][0])
+    np.testing.assert_array_equal(results[0][1], results[1][1])
+
+
+# A new simulation takes over the fields, so the old one can not be used anymore
+def test_replaced_simulation_raises():
+    old = main.Simulation("box", particles=50, seed=1)
+    main.Simulation("valley", particles=50, seed=1)
+    with pytest.raises(RuntimeError):
+        old.particle_positions()
+
+
+# The settings of a simulation stay in the simulation, the settings of main.py are left as they are
+def test_settings_stay_in_simulation():
+    settings = (main.engine, main.early_stop, main.ticks_per_launch, dict(main.init_options))
+    sim = main.Simulation("box", particles=50, seed=1, engine="grid", early_stop=True, fused_ticks=2)
+    sim.step(8)
+    assert (main.engine, main.early_stop, main.ticks_per_launch, main.init_options) == settings
+    assert any(config.engine == "grid" and config.monitor for config in main.kernel_configs.values())
+
+
+# Autodiff of the differentiable simulation gives the slope of the finite differences through the
+# ticks the gradient is taken through on the command line (With the smoothing of the command line)
+def test_gradient_matches_finite_differences():
+    main.Simulation("box", particles=500, seed=1)
+    ticks = main.args.grad_horizon
+    state, names, low, high, params = main.diff_setup(False, 500, ticks, layout_seed=1)
+    
+    main.diff_set_params(False, params)
+    value, forces_grad, physics_grad = main.diff_gradient(state, False, ticks, ticks, ticks)
+    grad = main.diff_param_gradient(False, forces_grad, physics_grad, low, high)
+    
+    for k in range(len(params)):
+        values = []
+        for sign in [1, -1]:
+            shifted = params.copy()
+            shifted[k] += sign * 1e-4 * (high[k] - low[k])
+            main.diff_set_params(False, shifted)
+            values.append(main.diff_gradient(state, False, ticks, ticks, ticks)[0])
+        slope = (values[0] - values[1]) / 2e-4
+        assert abs(grad[k] - slope) <= 0.05 * np.abs(grad).max(), names[k]